@@ -3,7 +3,10 @@ Configuration settings for OMR Evaluation Backend
 """
 
 from pydantic_settings import BaseSettings
-from typing import Optional
+from dotenv import dotenv_values
+from typing import Any, Dict, Optional
+from functools import lru_cache
+import json
 import os
 
 class Settings(BaseSettings):
@@ -14,6 +17,11 @@ class Settings(BaseSettings):
     database_name: str = "omr_evaluation"
     database_user: str = "user"
     database_password: str = "password"
+    database_pool_size: int = 10
+    database_max_overflow: int = 20
+    database_pool_timeout: int = 30
+    database_pool_recycle: int = 1800  # seconds (30 minutes) before a pooled connection is replaced
+    statistics_cache_ttl: int = 60
     
     # API settings
     api_host: str = "0.0.0.0"
@@ -24,6 +32,10 @@ class Settings(BaseSettings):
     upload_dir: str = "uploads"
     output_dir: str = "outputs"
     max_file_size: int = 10 * 1024 * 1024  # 10MB
+    # Uploads processed without include_overlay are kept so GET /results/{id}/overlay can render
+    # them, until first rendered or for this many hours (pruned at startup and hourly). Disk use
+    # is roughly uploads per hour x upload size x this value
+    upload_retention_hours: int = 24
     
     # OMR processing settings
     bubble_min_area: int = 100
@@ -31,6 +43,8 @@ class Settings(BaseSettings):
     fill_threshold_easy: float = 0.3
     fill_threshold_moderate: float = 0.5
     fill_threshold_strict: float = 0.8
+    # Worker processes that process sheets in parallel; 0 runs them on threads of the API process
+    omr_worker_processes: int = 0
     
     # Answer key settings
     answer_key_file: str = "data/answer_keys.json"
@@ -43,23 +57,30 @@ class Settings(BaseSettings):
     class Config:
         env_file = ".env"
         case_sensitive = False
+    
+    @classmethod
+    def settings_customise_sources(cls, settings_cls, init_settings, env_settings,
+                                   dotenv_settings, file_secret_settings):
+        # Values come from the snapshot passed to __init__ by get_settings
+        return (init_settings,)
 
-def get_settings() -> Settings:
-    """Get application settings"""
-    return Settings()
-
-# Create directories if they don't exist
-def ensure_directories():
-    """Ensure required directories exist"""
-    directories = [
-        "uploads",
-        "outputs", 
-        "logs",
-        "data"
-    ]
+def _env_snapshot() -> Dict[str, Any]:
+    """Read .env and the process environment once, keeping only Settings fields"""
+    snapshot = {**dotenv_values(Settings.Config.env_file), **os.environ}
+    values = {}
     
-    for directory in directories:
-        os.makedirs(directory, exist_ok=True)
+    for key, value in snapshot.items():
+        field_name = key.lower()
+        if value is None or field_name not in Settings.model_fields:
+            continue
+        # Complex fields are given as JSON, as pydantic-settings expects
+        if Settings.model_fields[field_name].annotation is list:
+            value = json.loads(value)
+        values[field_name] = value
+    
+    return values
 
-# Initialize directories
-ensure_directories()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Get application settings (built once per process; use get_settings.cache_clear() to reload)"""
+    return Settings(**_env_snapshot())
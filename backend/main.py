@@ -2,11 +2,22 @@
 FastAPI Backend for Automated OMR Evaluation System
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, BackgroundTasks, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.exceptions import HTTPException as StarletteHTTPException
 import uvicorn
+import asyncio
+import orjson
+import glob
 import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
 from typing import List, Optional
 import logging
 
@@ -19,26 +30,59 @@ from config.settings import get_settings
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Sweep expired stored uploads for as long as the server runs"""
+    prune_task = asyncio.create_task(_prune_uploads_periodically())
+    try:
+        yield
+    finally:
+        prune_task.cancel()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="OMR Evaluation API",
     description="Automated OMR sheet processing and evaluation",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["http://localhost:3000", "http://localhost:8080", "http://localhost:8084", "http://localhost:8088", "http://localhost:5173"],
+    allow_origin_regex=r"^http://localhost:(3000|5173|8080|8084|8088)$",
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+class JSONGZipMiddleware(GZipMiddleware):
+    """GZip responses except overlay images, which are already JPEG-compressed"""
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith("/overlay"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# Level 1 gets most of the size win on repetitive result JSON for little CPU
+app.add_middleware(JSONGZipMiddleware, minimum_size=1024, compresslevel=1)
+
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+    """Serialize error responses with orjson too (FastAPI's default handler uses JSONResponse)"""
+    headers = getattr(exc, "headers", None)
+    # No-body statuses get an empty response, as in Starlette's default handler
+    if exc.status_code in {204, 304}:
+        return Response(status_code=exc.status_code, headers=headers)
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=headers)
+
 # Initialize services
 settings = get_settings()
 omr_processor = OMRProcessor()
 db_service = DatabaseService()
+_upload_dir_ready = False
 
 @app.get("/")
 async def root():
@@ -58,26 +102,30 @@ async def health_check():
         }
     except Exception as e:
         logger.error(f"Health check failed: {e}")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=503,
             content={"status": "unhealthy", "error": str(e)}
         )
 
 @app.post("/process-omr", response_model=OMRProcessResponse)
 async def process_omr(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     evaluation_mode: str = "moderate",
     student_id: Optional[str] = None,
-    test_data: Optional[str] = None  # JSON string containing test subjects and answer key
+    test_data: Optional[str] = None,  # JSON string containing test subjects and answer key
+    include_overlay: bool = False
 ):
     """
     Process uploaded OMR sheet image
     
     Args:
+        background_tasks: Runs the database save after the response is sent
         file: OMR sheet image (JPG/PNG/PDF)
         evaluation_mode: Evaluation mode (easy/moderate/strict)
         student_id: Optional student ID for identification
         test_data: JSON string containing test subjects and answer key
+        include_overlay: Render the overlay image now instead of on GET /results/{id}/overlay
     
     Returns:
         OMRProcessResponse with processing results
@@ -104,59 +152,228 @@ async def process_omr(
         test_answer_key = None
         if test_data:
             try:
-                import json
-                test_info = json.loads(test_data)
+                test_info = orjson.loads(test_data)
                 test_subjects = test_info.get('subjects', [])
                 test_answer_key = test_info.get('answerKey', [])
                 logger.info(f"Using test-specific data: {len(test_subjects)} subjects, {len(test_answer_key)} questions")
-                logger.info(f"Test subjects: {test_subjects}")
-                logger.info(f"Test answer key: {test_answer_key}")
-            except json.JSONDecodeError as e:
+                logger.debug("Test subjects: %s", test_subjects)
+                logger.debug("Test answer key: %s", test_answer_key)
+            except orjson.JSONDecodeError as e:
                 logger.warning(f"Invalid test_data JSON: {e}, using default answer key")
         else:
             logger.info("No test_data provided, using default answer key")
         
-        # Read file content
-        file_content = await file.read()
+        # Stream upload to disk instead of reading it into memory
+        global _upload_dir_ready
+        if not _upload_dir_ready:
+            os.makedirs(settings.upload_dir, exist_ok=True)
+            _upload_dir_ready = True
         
-        # Process OMR sheet with test data
-        logger.info(f"Calling process_sheet with test_subjects: {test_subjects}, test_answer_key: {test_answer_key}")
-        result = await omr_processor.process_sheet(
-            file_content=file_content,
-            filename=file.filename,
-            evaluation_mode=evaluation_mode,
-            student_id=student_id,
-            test_subjects=test_subjects,
-            test_answer_key=test_answer_key
+        tmp = tempfile.NamedTemporaryFile(
+            dir=settings.upload_dir, suffix=os.path.splitext(file.filename or "")[1], delete=False
         )
-        logger.info(f"Process sheet result: success={result.success}, subject_scores={result.subject_scores}")
-        
-        # Store results in database
-        await db_service.save_omr_result(result)
+        upload_path = tmp.name
+        try:
+            # Inside the try so a copy cut short by a disconnect does not leave a partial file
+            with tmp:
+                await run_in_threadpool(shutil.copyfileobj, file.file, tmp, 1 << 20)
+            
+            # Process OMR sheet with test data, under the ID it will be stored with
+            result_id = db_service.new_result_id()
+            logger.debug("Calling process_sheet with test_subjects: %s, test_answer_key: %s", test_subjects, test_answer_key)
+            result = await omr_processor.process_sheet(
+                file_content=None,
+                filename=file.filename,
+                evaluation_mode=evaluation_mode,
+                student_id=student_id,
+                test_subjects=test_subjects,
+                test_answer_key=test_answer_key,
+                file_path=upload_path,
+                include_overlay=include_overlay,
+                result_id=result_id
+            )
+            logger.debug("Process sheet result: success=%s, subject_scores=%s", result.success, result.subject_scores)
+            
+            # Store results in database once the response has been sent
+            background_tasks.add_task(_save_result, result)
+            
+            # Keep the upload so the overlay can be rendered on demand
+            if result.success and not include_overlay:
+                await run_in_threadpool(
+                    _keep_overlay_source, result.result_id, upload_path, file.filename, test_subjects, test_answer_key
+                )
+        finally:
+            if os.path.exists(upload_path):
+                os.remove(upload_path)
         
         logger.info(f"Successfully processed OMR sheet: {file.filename}")
-        return result
+        # Serialize the already-validated model once (response_model is kept for the API schema only)
+        return Response(content=result.model_dump_json(), media_type="application/json")
         
     except Exception as e:
         logger.error(f"Error processing OMR sheet {file.filename}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _save_result(result: OMRProcessResponse):
+    """Store a processed result, dropping its kept upload if the save fails"""
+    try:
+        await db_service.save_omr_result(result)
+    except Exception as e:
+        logger.error(f"Error saving result {result.result_id}: {e}")
+        if result.result_id:
+            await run_in_threadpool(_remove_overlay_source, result.result_id)
+
+def _overlay_source_path(result_id: str) -> str:
+    """Path of the JSON record describing the stored upload of a result"""
+    return os.path.join(settings.upload_dir, f"{result_id}.json")
+
+def _keep_overlay_source(result_id: str, upload_path: str, filename: str,
+                         test_subjects: Optional[list], test_answer_key: Optional[list]):
+    """Move an upload next to a record of the test data it was evaluated with"""
+    image_path = os.path.join(settings.upload_dir, f"{result_id}{os.path.splitext(upload_path)[1]}")
+    os.replace(upload_path, image_path)
+    
+    with open(_overlay_source_path(result_id), "wb") as f:
+        f.write(orjson.dumps({
+            "image_path": image_path,
+            "filename": filename,
+            "test_subjects": test_subjects,
+            "test_answer_key": test_answer_key
+        }))
+
+def _remove_overlay_source(result_id: str):
+    """Delete the stored upload of a result, if any"""
+    source_path = _overlay_source_path(result_id)
+    if os.path.exists(source_path):
+        with open(source_path, "rb") as f:
+            image_path = orjson.loads(f.read())["image_path"]
+        if os.path.exists(image_path):
+            os.remove(image_path)
+        os.remove(source_path)
+
+def _remove_result_files(result_id: str):
+    """Delete the stored upload and any rendered overlay images of a result"""
+    _remove_overlay_source(result_id)
+    overlay_pattern = os.path.join(glob.escape(settings.output_dir), f"overlay_{glob.escape(result_id)}_*")
+    for overlay_path in glob.glob(overlay_pattern):
+        with suppress(FileNotFoundError):
+            os.remove(overlay_path)
+
+async def _prune_uploads_periodically():
+    """Prune stored uploads at startup, then every hour whether or not uploads arrive"""
+    while True:
+        try:
+            await run_in_threadpool(_prune_uploads)
+        except Exception as e:
+            logger.error(f"Error pruning uploads: {e}")
+        await asyncio.sleep(3600)
+
+def _prune_uploads():
+    """Delete stored uploads older than settings.upload_retention_hours"""
+    if not os.path.isdir(settings.upload_dir):
+        return
+    
+    cutoff = time.time() - settings.upload_retention_hours * 3600
+    with os.scandir(settings.upload_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            # Another request may remove the same file first
+            with suppress(FileNotFoundError):
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+
+@app.get("/results/{result_id}/overlay")
+async def get_result_overlay(result_id: str):
+    """Get the overlay image of a result, rendering it on first request"""
+    try:
+        # The result is saved after its response is sent, so until then only the kept upload exists
+        result = await db_service.get_result_by_id(result_id)
+        source_path = _overlay_source_path(result_id)
+        if not result and not os.path.exists(source_path):
+            raise HTTPException(status_code=404, detail="Result not found")
+        
+        # Results processed without include_overlay store the link to this endpoint until it renders
+        overlay_url = result["overlay_image_path"] if result else None
+        if not overlay_url or overlay_url == omr_processor.DEFERRED_OVERLAY_URL.format(result_id=result_id):
+            if not os.path.exists(source_path):
+                raise HTTPException(status_code=404, detail="No overlay available for this result")
+            
+            with open(source_path, "rb") as f:
+                source = orjson.loads(f.read())
+            
+            overlay_url = await omr_processor.render_overlay(
+                source["image_path"], source["filename"],
+                source["test_subjects"], source["test_answer_key"], result_id
+            )
+            if not overlay_url:
+                raise HTTPException(status_code=500, detail="Failed to render overlay image")
+            # The upload is no longer needed once the stored result points at the rendered image
+            if result and await db_service.update_overlay_path(result_id, overlay_url):
+                await run_in_threadpool(_remove_overlay_source, result_id)
+        
+        return FileResponse(os.path.join(settings.output_dir, os.path.basename(overlay_url)))
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching overlay for result {result_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/results/{student_id}")
 async def get_student_results(student_id: str):
-    """Get all results for a specific student"""
+    """Get all results for a specific student, streamed as they are read"""
+    # One reader thread runs the whole query, so its session and cursor never change threads
+    reader = ThreadPoolExecutor(max_workers=1)
+    chunks = db_service.iter_student_results(student_id)
     try:
-        results = await db_service.get_student_results(student_id)
-        return {"student_id": student_id, "results": results}
+        # Read the first chunk before responding, so a failing database still gives a 500
+        first_chunk = await asyncio.get_running_loop().run_in_executor(reader, _next_results_json, chunks)
     except Exception as e:
+        reader.shutdown(wait=False)
         logger.error(f"Error fetching results for student {student_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    
+    return StreamingResponse(
+        _student_results_body(student_id, first_chunk, chunks, reader), media_type="application/json"
+    )
+
+def _next_results_json(chunks) -> Optional[bytes]:
+    """Next chunk of results as comma-separated JSON objects, or None when done (runs on the reader thread)"""
+    chunk = next(chunks, None)
+    return None if chunk is None else b",".join(orjson.dumps(result) for result in chunk)
+
+async def _student_results_body(student_id: str, first_chunk: Optional[bytes], chunks, reader: ThreadPoolExecutor):
+    """JSON body of get_student_results, written a chunk of results at a time"""
+    try:
+        yield b'{"student_id":' + orjson.dumps(student_id) + b',"results":['
+        chunk, separator = first_chunk, b""
+        while chunk is not None:
+            yield separator + chunk
+            separator = b","
+            try:
+                chunk = await asyncio.get_running_loop().run_in_executor(reader, _next_results_json, chunks)
+            except Exception as e:
+                # Headers are already sent: re-raising aborts the connection so the client sees a failed
+                # transfer rather than a complete-looking body
+                logger.error(f"Error streaming results for student {student_id}: {e}")
+                raise
+        yield b"]}"
+    finally:
+        # Close the query on its own thread, releasing the connection even when the client went away
+        reader.submit(chunks.close)
+        reader.shutdown(wait=False)
 
 @app.get("/results")
-async def get_all_results(limit: int = 100, offset: int = 0):
-    """Get all OMR results with pagination"""
+async def get_all_results(limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None, fields: Optional[str] = None):
+    """Get all OMR results with pagination (pass next_cursor back as cursor); fields is an optional comma-separated subset of result keys"""
     try:
-        results = await db_service.get_all_results(limit=limit, offset=offset)
-        return {"results": results, "limit": limit, "offset": offset}
+        page = await db_service.get_all_results(
+            limit=limit, cursor=cursor, fields=fields.split(",") if fields else None
+        )
+        return {"results": page["results"], "limit": limit, "next_cursor": page["next_cursor"]}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error fetching results: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -166,6 +383,7 @@ async def delete_result(result_id: str):
     """Delete a specific OMR result"""
     try:
         await db_service.delete_result(result_id)
+        await run_in_threadpool(_remove_result_files, result_id)
         return {"message": "Result deleted successfully"}
     except Exception as e:
         logger.error(f"Error deleting result {result_id}: {e}")
@@ -3,17 +3,30 @@ OMR Core Package
 Comprehensive Optical Mark Recognition system
 """
 
-from .core import OMRCore, create_omr_core
-from .template import Template, FieldBlock, Bubble
-from .processors import ImageProcessorFactory, ImageInstanceOps
-from .bubble_detection import BubbleDetector, BubbleDetectionResult
-from .evaluation import OMREvaluator, EvaluationConfig, ScoringReport, EvaluationResult
+import importlib
+
+# Submodules (and OpenCV behind them) are imported on first attribute access
+_LAZY_EXPORTS = {
+    'OMRCore': '.core',
+    'create_omr_core': '.core',
+    'Template': '.template',
+    'FieldBlock': '.template',
+    'Bubble': '.template',
+    'ImageProcessorFactory': '.processors',
+    'ImageInstanceOps': '.processors',
+    'BubbleDetector': '.bubble_detection',
+    'BubbleDetectionResult': '.bubble_detection',
+    'OMREvaluator': '.evaluation',
+    'EvaluationConfig': '.evaluation',
+    'ScoringReport': '.evaluation',
+    'EvaluationResult': '.evaluation'
+}
 
 __all__ = [
     'OMRCore',
     'create_omr_core',
     'Template',
-    'FieldBlock', 
+    'FieldBlock',
     'Bubble',
     'ImageProcessorFactory',
     'ImageInstanceOps',
@@ -24,3 +37,15 @@ __all__ = [
     'ScoringReport',
     'EvaluationResult'
 ]
+
+
+def __getattr__(name):
+    if name in _LAZY_EXPORTS:
+        value = getattr(importlib.import_module(_LAZY_EXPORTS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -4,12 +4,27 @@ Implements global and local thresholding for robust bubble detection
 """
 
 import cv2
+import logging
 import numpy as np
 from typing import Dict, List, Tuple, Optional, Any
 from dataclasses import dataclass
+from functools import partial
 
+logger = logging.getLogger(__name__)
 
-@dataclass
+
+def largest_gap(q_sorted: np.ndarray, min_jump: float, default_thr: float) -> Tuple[float, float]:
+    """Find the largest jump q[i+1] - q[i-1] in sorted values, returning (threshold, jump)"""
+    if len(q_sorted) > 2:
+        jumps = q_sorted[2:] - q_sorted[:-2]
+        i = int(np.argmax(jumps))
+        if jumps[i] > min_jump:
+            return q_sorted[i] + jumps[i] / 2, jumps[i]
+    
+    return default_thr, min_jump
+
+
+@dataclass(slots=True, frozen=True)
 class BubbleDetectionResult:
     """Result of bubble detection for a single bubble"""
     is_marked: bool
@@ -36,6 +51,11 @@ class BubbleDetector:
         
         # Global default threshold
         self.global_default_threshold = 200 if self.page_type == "white" else 100
+        
+        # Constants derived from the tuning config, fixed for the detector's lifetime
+        self.confident_jump = self.min_jump + self.confident_surplus
+        self._global_gap = partial(largest_gap, min_jump=self.min_jump, default_thr=self.global_default_threshold)
+        self._local_gap = partial(largest_gap, min_jump=self.min_jump, default_thr=255)
     
     def detect_bubbles(self, image: np.ndarray, template, file_path: str = None) -> Dict[str, Any]:
         """Main bubble detection pipeline"""
@@ -43,19 +63,24 @@ class BubbleDetector:
             # Resize image to template dimensions
             img = cv2.resize(image, (template.page_dimensions[0], template.page_dimensions[1]))
             
-            # Normalize image
-            if img.max() > img.min():
-                img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX)
-            
-            # Convert to grayscale if needed
+            # Convert to grayscale if needed (the resized image is already a fresh buffer)
             if len(img.shape) == 3:
                 gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
             else:
-                gray = img.copy()
+                gray = img
+            del img
+            
+            # Normalize in place, skipping flat images and ones already spanning 0-255
+            min_val, max_val = cv2.minMaxLoc(gray)[:2]
+            if max_val > min_val and (min_val > 0 or max_val < 255):
+                cv2.normalize(gray, gray, 0, 255, cv2.NORM_MINMAX)
             
             # Calculate global threshold
             global_thr, global_low, global_high = self.get_global_threshold(gray)
             
+            # Summed-area table shared by all field blocks
+            integral = cv2.integral(gray)
+            
             # Process each field block
             omr_response = {}
             final_marked = []
@@ -64,7 +89,7 @@ class BubbleDetector:
             
             for field_block in template.field_blocks:
                 field_response, marked, multi, roll = self.process_field_block(
-                    field_block, gray, global_thr, template.bubble_dimensions
+                    field_block, gray, global_thr, template.bubble_dimensions, integral
                 )
                 omr_response.update(field_response)
                 final_marked.extend(marked)
@@ -79,8 +104,8 @@ class BubbleDetector:
                 "global_threshold": global_thr
             }
             
-        except Exception as e:
-            print(f"Error in detect_bubbles: {e}")
+        except Exception:
+            logger.exception("Error in detect_bubbles")
             return {
                 "omr_response": {},
                 "final_marked": [],
@@ -92,19 +117,20 @@ class BubbleDetector:
     def get_global_threshold(self, image: np.ndarray, plot_title: str = None, plot_show: bool = False) -> Tuple[float, float, float]:
         """Calculate global threshold using intensity distribution analysis"""
         try:
-            # Flatten image and get intensity values
-            q_vals_orig = image.flatten()
-            q_vals = sorted(q_vals_orig)
+            # Intensity histogram instead of sorting every pixel
+            if image.dtype == np.uint8:
+                hist = np.bincount(image.ravel(), minlength=256)
+                populated = np.flatnonzero(hist)
+                counts = hist[populated]
+            else:
+                populated, counts = np.unique(image, return_counts=True)
             
-            # Find largest gap in intensity distribution
-            l = len(q_vals) - 1
-            max1, thr1 = self.min_jump, self.global_default_threshold
+            # Jumps between neighbours of the sorted pixels only depend on runs of
+            # at most two equal values, so the sorted order collapses to <= 512 entries
+            q_vals = np.repeat(populated, np.minimum(counts, 2)).astype(np.float64)
             
-            for i in range(1, l):
-                jump = q_vals[i + 1] - q_vals[i - 1]
-                if jump > max1:
-                    max1 = jump
-                    thr1 = q_vals[i - 1] + jump / 2
+            # Find largest gap in intensity distribution
+            thr1, max1 = self._global_gap(q_vals)
             
             # Calculate threshold bounds
             thr_low = thr1 - max1 // 2
@@ -118,105 +144,94 @@ class BubbleDetector:
             
             return thr1, thr_low, thr_high
             
-        except Exception as e:
-            print(f"Error in get_global_threshold: {e}")
+        except Exception:
+            logger.exception("Error in get_global_threshold")
             return self.global_default_threshold, self.global_default_threshold - 50, self.global_default_threshold + 50
     
     def get_local_threshold(self, q_vals: List[float], global_thr: float, no_outliers: bool = True, 
                           plot_title: str = None, plot_show: bool = False) -> float:
         """Calculate local threshold for a specific question strip"""
         try:
-            if len(q_vals) < 3:
-                return global_thr if np.max(q_vals) - np.min(q_vals) < self.min_gap else np.mean(q_vals)
+            q_vals = np.sort(np.asarray(q_vals, dtype=np.float64))
             
-            q_vals = sorted(q_vals)
+            if len(q_vals) == 0:
+                return global_thr
             
-            # Find largest gap in local values
-            l = len(q_vals) - 1
-            max1, thr1 = self.min_jump, 255
+            # Range is O(1) once sorted
+            if len(q_vals) < 3:
+                return global_thr if q_vals[-1] - q_vals[0] < self.min_gap else np.mean(q_vals)
             
-            for i in range(1, l):
-                jump = q_vals[i + 1] - q_vals[i - 1]
-                if jump > max1:
-                    max1 = jump
-                    thr1 = q_vals[i - 1] + jump / 2
+            # Find largest gap in local values
+            thr1, max1 = self._local_gap(q_vals)
             
             # Use global threshold if local confidence is low
-            confident_jump = self.min_jump + self.confident_surplus
-            if max1 < confident_jump:
+            if max1 < self.confident_jump:
                 return global_thr if no_outliers else global_thr
             
             return thr1
             
-        except Exception as e:
-            print(f"Error in get_local_threshold: {e}")
+        except Exception:
+            logger.exception("Error in get_local_threshold")
             return global_thr
     
     def process_field_block(self, field_block, image: np.ndarray, global_thr: float, 
-                          bubble_dimensions: List[int]) -> Tuple[Dict[str, str], List[str], List[str], List[str]]:
+                          bubble_dimensions: List[int], integral: np.ndarray = None) -> Tuple[Dict[str, str], List[str], List[str], List[str]]:
         """Process a single field block"""
         try:
             box_w, box_h = bubble_dimensions
-            field_response = {}
-            marked = []
-            multi_marked = []
             multi_roll = []
             
-            # Collect all bubble intensities for local thresholding
-            all_intensities = []
-            for field_bubbles in field_block.traverse_bubbles:
-                for bubble in field_bubbles:
-                    x, y = int(bubble.x + field_block.shift), int(bubble.y)
-                    rect = [y, y + box_h, x, x + box_w]
-                    
-                    # Ensure coordinates are within image bounds
-                    if (rect[0] >= 0 and rect[1] <= image.shape[0] and 
-                        rect[2] >= 0 and rect[3] <= image.shape[1]):
-                        bubble_intensity = cv2.mean(image[rect[0]:rect[1], rect[2]:rect[3]])[0]
-                        all_intensities.append(bubble_intensity)
+            if integral is None:
+                integral = cv2.integral(image)
+            
+            # Bubble offsets and in-bounds mask precomputed on the template
+            xs, ys, in_bounds = field_block.get_bubble_boxes(image.shape[0], image.shape[1])
+            
+            # Mean intensity of every bubble from the summed-area table
+            intensities = self.get_bubble_intensities(integral, xs, ys, box_w, box_h, in_bounds)
             
             # Calculate local threshold for this field block
-            local_thr = self.get_local_threshold(all_intensities, global_thr)
+            local_thr = self.get_local_threshold(intensities[in_bounds], global_thr)
             
-            # Process each question
-            for field_bubbles in field_block.traverse_bubbles:
-                field_label = field_bubbles[0].field_label
-                detected_bubbles = []
-                
-                # Check each bubble for this question
-                for bubble in field_bubbles:
-                    x, y = int(bubble.x + field_block.shift), int(bubble.y)
-                    rect = [y, y + box_h, x, x + box_w]
-                    
-                    # Ensure coordinates are within image bounds
-                    if (rect[0] >= 0 and rect[1] <= image.shape[0] and 
-                        rect[2] >= 0 and rect[3] <= image.shape[1]):
-                        
-                        bubble_intensity = cv2.mean(image[rect[0]:rect[1], rect[2]:rect[3]])[0]
-                        bubble_is_marked = local_thr > bubble_intensity
-                        
-                        if bubble_is_marked:
-                            detected_bubbles.append(bubble)
-                
-                # Handle detection results
-                if len(detected_bubbles) > 1:
-                    # Multiple bubbles marked
-                    multi_marked.append(field_label)
-                    field_response[field_label] = ''.join([b.field_value for b in detected_bubbles])
-                elif len(detected_bubbles) == 1:
-                    # Single bubble marked
-                    field_response[field_label] = detected_bubbles[0].field_value
-                    marked.append(field_label)
-                else:
-                    # No bubbles marked
-                    field_response[field_label] = field_block.empty_value
+            marks = in_bounds & np.less(intensities, local_thr)
+            
+            # Count the marks of every question at once, then only visit the marked bubbles
+            offsets = field_block.question_offsets
+            labels = field_block.question_labels
+            counts = np.diff(np.concatenate(([0], np.cumsum(marks)))[offsets])
+            marked_bubbles = np.flatnonzero(marks)
+            marked_questions = np.searchsorted(offsets, marked_bubbles, side="right") - 1
+            
+            # Unmarked questions get the empty value, multi-marked ones every detected value
+            detected_values = {}
+            for q, i in zip(marked_questions.tolist(), marked_bubbles.tolist()):
+                detected_values.setdefault(q, []).append(field_block.bubble_values[i])
+            field_response = {
+                field_label: ''.join(detected_values[q]) if q in detected_values else field_block.empty_value
+                for q, field_label in enumerate(labels)
+            }
+            
+            marked = [labels[q] for q in np.flatnonzero(counts == 1).tolist()]
+            multi_marked = [labels[q] for q in np.flatnonzero(counts > 1).tolist()]
             
             return field_response, marked, multi_marked, multi_roll
             
-        except Exception as e:
-            print(f"Error in process_field_block: {e}")
+        except Exception:
+            logger.exception("Error in process_field_block")
             return {}, [], [], []
     
+    def get_bubble_intensities(self, integral: np.ndarray, xs: np.ndarray, ys: np.ndarray,
+                               box_w: int, box_h: int, in_bounds: np.ndarray) -> np.ndarray:
+        """Calculate mean intensity of each bubble box using an integral image"""
+        intensities = np.full(len(xs), 255.0)
+        x0, y0 = xs[in_bounds], ys[in_bounds]
+        x1, y1 = x0 + box_w, y0 + box_h
+        
+        sums = (integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]).astype(np.float64)
+        intensities[in_bounds] = sums * (1.0 / (box_w * box_h))
+        
+        return intensities
+    
     def detect_bubble_with_confidence(self, image: np.ndarray, bubble, bubble_dimensions: List[int], 
                                     threshold: float) -> BubbleDetectionResult:
         """Detect a single bubble with confidence score"""
@@ -251,8 +266,8 @@ class BubbleDetector:
                     bubble=bubble
                 )
                 
-        except Exception as e:
-            print(f"Error in detect_bubble_with_confidence: {e}")
+        except Exception:
+            logger.exception("Error in detect_bubble_with_confidence")
             return BubbleDetectionResult(
                 is_marked=False,
                 confidence=0.0,
@@ -265,32 +280,52 @@ class BubbleDetector:
                           output_path: str = None) -> np.ndarray:
         """Create visualization of bubble detection results"""
         try:
-            # Create a copy of the image for visualization
+            # Create a copy of the image for visualization. Drawing stays on a host ndarray:
+            # OpenCV's drawing functions have no OpenCL kernels, so a cv2.UMat would only
+            # add upload/download copies (and cv2.polylines rejects UMat images in 4.8)
             vis_image = image.copy()
             if len(vis_image.shape) == 2:
                 vis_image = cv2.cvtColor(vis_image, cv2.COLOR_GRAY2BGR)
             
-            # Draw detected bubbles
+            w, h = template.bubble_dimensions
+            omr_response = detection_results["omr_response"]
+            all_boxes = []
+            all_marked = []
+            all_values = []
+            
+            # Collect bubble boxes from every field block
             for field_block in template.field_blocks:
-                for field_bubbles in field_block.traverse_bubbles:
-                    for bubble in field_bubbles:
-                        x, y = int(bubble.x + field_block.shift), int(bubble.y)
-                        w, h = template.bubble_dimensions
-                        
-                        # Check if this bubble was marked
-                        field_label = bubble.field_label
-                        is_marked = detection_results["omr_response"].get(field_label) == bubble.field_value
-                        
-                        # Choose color based on detection result
-                        color = (0, 255, 0) if is_marked else (0, 0, 255)  # Green for marked, Red for unmarked
-                        thickness = 2 if is_marked else 1
-                        
-                        # Draw rectangle
-                        cv2.rectangle(vis_image, (x, y), (x + w, y + h), color, thickness)
-                        
-                        # Add text label
-                        cv2.putText(vis_image, bubble.field_value, (x, y - 5), 
-                                  cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+                xs, ys, _ = field_block.get_bubble_boxes(vis_image.shape[0], vis_image.shape[1])
+                xs, ys = xs.astype(np.int32), ys.astype(np.int32)
+                
+                # Check which bubbles were marked
+                labels = np.repeat(field_block.question_labels, np.diff(field_block.question_offsets))
+                all_marked.extend(omr_response.get(field_label) == field_value
+                                  for field_label, field_value in zip(labels, field_block.bubble_values))
+                all_values.extend(field_block.bubble_values)
+                
+                all_boxes.append(np.stack([
+                    np.stack([xs, ys], axis=1),
+                    np.stack([xs + w, ys], axis=1),
+                    np.stack([xs + w, ys + h], axis=1),
+                    np.stack([xs, ys + h], axis=1)
+                ], axis=1))
+            
+            if all_boxes:
+                boxes = np.concatenate(all_boxes)
+                is_marked = np.array(all_marked, dtype=bool)
+                
+                # Draw all rectangles in one call per style: Green for marked, Red for unmarked
+                for marked, color, thickness in ((False, (0, 0, 255), 1), (True, (0, 255, 0), 2)):
+                    selected = boxes[is_marked == marked]
+                    if len(selected):
+                        cv2.polylines(vis_image, selected, True, color, thickness)
+                
+                # Add text labels
+                for (x, y), field_value, marked in zip(boxes[:, 0], all_values, is_marked):
+                    color = (0, 255, 0) if marked else (0, 0, 255)
+                    cv2.putText(vis_image, field_value, (int(x), int(y) - 5), 
+                              cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
             
             # Save visualization if output path provided
             if output_path:
@@ -298,6 +333,6 @@ class BubbleDetector:
             
             return vis_image
             
-        except Exception as e:
-            print(f"Error in visualize_detection: {e}")
+        except Exception:
+            logger.exception("Error in visualize_detection")
             return image
@@ -3,11 +3,15 @@ Main OMR Processing Core
 Integrates template system, image processing, bubble detection, and evaluation
 """
 
+import csv
 import cv2
+import logging
 import numpy as np
+import orjson
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Dict, List, Tuple, Optional, Any
 from pathlib import Path
-import json
+import os
 import time
 
 from .template import Template, FieldBlock
@@ -15,6 +19,8 @@ from .processors import ImageProcessorFactory, ImageInstanceOps
 from .bubble_detection import BubbleDetector
 from .evaluation import OMREvaluator, EvaluationConfig, ScoringReport
 
+logger = logging.getLogger(__name__)
+
 
 class OMRCore:
     """Main OMR processing system"""
@@ -23,12 +29,19 @@ class OMRCore:
         self.config = config
         self.tuning_config = config.get("tuning", {})
         self.template = None
+        self.preprocessors = []
         self.image_processor = ImageInstanceOps(self.tuning_config)
         self.bubble_detector = BubbleDetector(self.tuning_config)
         self.evaluator = None
         
         # Initialize default configuration
         self._setup_default_config()
+        
+        # Visualize only when detections are saved or shown; configs that do not ask for it skip drawing
+        outputs = self.config["tuning"].get("outputs", {})
+        self.visualize_detections = (
+            outputs.get("save_detections", False) or outputs.get("show_image_level", 0) > 0
+        )
     
     def _setup_default_config(self):
         """Setup default configuration if not provided"""
@@ -68,18 +81,23 @@ class OMRCore:
         try:
             self.template = Template(template_path, self.tuning_config)
             
+            # Preprocessors only hold their options, so one pipeline serves every image
+            self.preprocessors = ImageProcessorFactory.create_processors_from_config(
+                self.template.preprocessors_config
+            )
+            
             if not self.template.validate_template():
-                print("Warning: Template validation failed")
+                logger.warning("Template validation failed")
                 return False
             
-            print(f"Template loaded successfully: {template_path}")
-            print(f"Page dimensions: {self.template.page_dimensions}")
-            print(f"Field blocks: {len(self.template.field_blocks)}")
+            logger.info(f"Template loaded successfully: {template_path}")
+            logger.info(f"Page dimensions: {self.template.page_dimensions}")
+            logger.info(f"Field blocks: {len(self.template.field_blocks)}")
             
             return True
             
-        except Exception as e:
-            print(f"Error loading template: {e}")
+        except Exception:
+            logger.exception("Error loading template")
             return False
     
     def create_template_from_test_data(self, test_subjects: List[Dict], answer_key: List[str], 
@@ -128,14 +146,13 @@ class OMRCore:
             
             # Save template
             Path(template_path).parent.mkdir(parents=True, exist_ok=True)
-            with open(template_path, 'w') as f:
-                json.dump(template_config, f, indent=2)
+            Path(template_path).write_bytes(orjson.dumps(template_config, option=orjson.OPT_INDENT_2))
             
             # Load the created template
             return self.load_template(template_path)
             
-        except Exception as e:
-            print(f"Error creating template from test data: {e}")
+        except Exception:
+            logger.exception("Error creating template from test data")
             return False
     
     def setup_evaluator(self, test_subjects: List[Dict] = None, answer_key: List[str] = None):
@@ -147,13 +164,14 @@ class OMRCore:
                 evaluation_config = EvaluationConfig.create_default_config()
             
             self.evaluator = OMREvaluator(evaluation_config)
-            print("Evaluator setup successfully")
+            logger.info("Evaluator setup successfully")
             
-        except Exception as e:
-            print(f"Error setting up evaluator: {e}")
+        except Exception:
+            logger.exception("Error setting up evaluator")
     
-    def process_omr_image(self, image: np.ndarray, file_path: str = None) -> Dict[str, Any]:
-        """Process OMR image and return results"""
+    def process_omr_image(self, image: np.ndarray, file_path: str = None,
+                          include_visualization: Optional[bool] = None, return_encoded: bool = False) -> Dict[str, Any]:
+        """Process OMR image and return results, visualizing per the outputs config unless overridden"""
         try:
             if not self.template:
                 raise ValueError("No template loaded")
@@ -161,36 +179,44 @@ class OMRCore:
             if not self.evaluator:
                 raise ValueError("No evaluator setup")
             
-            start_time = time.time()
+            start_ns = time.perf_counter_ns()
             
             # Step 1: Image preprocessing
-            print("Step 1: Image preprocessing...")
-            preprocessors = ImageProcessorFactory.create_processors_from_config(
-                self.template.preprocessors_config
-            )
+            logger.debug("Step 1: Image preprocessing...")
             processed_image = self.image_processor.apply_preprocessors(
-                file_path or "unknown", image, preprocessors
+                file_path or "unknown", image, self.preprocessors
             )
             
             # Step 2: Bubble detection
-            print("Step 2: Bubble detection...")
+            logger.debug("Step 2: Bubble detection...")
             detection_results = self.bubble_detector.detect_bubbles(
                 processed_image, self.template, file_path
             )
             
             # Step 3: Answer evaluation
-            print("Step 3: Answer evaluation...")
+            logger.debug("Step 3: Answer evaluation...")
             scoring_report = self.evaluator.evaluate_omr_response(
                 detection_results["omr_response"], file_path
             )
             
             # Step 4: Generate visualization
-            print("Step 4: Generating visualization...")
-            visualization = self.bubble_detector.visualize_detection(
-                processed_image, self.template, detection_results
-            )
-            
-            processing_time = (time.time() - start_time) * 1000
+            visualization = None
+            if include_visualization is None:
+                include_visualization = self.visualize_detections
+            if include_visualization:
+                logger.debug("Step 4: Generating visualization...")
+                visualization = self.bubble_detector.visualize_detection(
+                    processed_image, self.template, detection_results
+                )
+            
+            # Encode the visualization as PNG bytes when the caller only stores or ships it
+            visualization_png = None
+            if return_encoded and visualization is not None:
+                ok, buffer = cv2.imencode('.png', visualization)
+                visualization_png = buffer.tobytes() if ok else None
+                visualization = None
+            
+            processing_time = (time.perf_counter_ns() - start_ns) / 1_000_000
             
             # Compile results
             results = {
@@ -205,6 +231,7 @@ class OMRCore:
                     "multi_roll": detection_results["multi_roll"]
                 },
                 "visualization": visualization,
+                "visualization_png": visualization_png,
                 "template_info": {
                     "page_dimensions": self.template.page_dimensions,
                     "bubble_dimensions": self.template.bubble_dimensions,
@@ -212,13 +239,13 @@ class OMRCore:
                 }
             }
             
-            print(f"OMR processing completed in {processing_time:.2f}ms")
-            print(f"Score: {scoring_report.total_score:.2f}/{scoring_report.max_possible_score:.2f} ({scoring_report.percentage:.2f}%)")
+            logger.info(f"OMR processing completed in {processing_time:.2f}ms")
+            logger.info(f"Score: {scoring_report.total_score:.2f}/{scoring_report.max_possible_score:.2f} ({scoring_report.percentage:.2f}%)")
             
             return results
             
         except Exception as e:
-            print(f"Error processing OMR image: {e}")
+            logger.exception("Error processing OMR image")
             return {
                 "success": False,
                 "error": str(e),
@@ -227,18 +254,18 @@ class OMRCore:
                 "scoring_report": None
             }
     
-    def process_omr_file(self, file_path: str) -> Dict[str, Any]:
+    def process_omr_file(self, file_path: str, return_encoded: bool = False) -> Dict[str, Any]:
         """Process OMR file from disk"""
         try:
-            # Load image
-            image = cv2.imread(file_path)
+            # Load image as grayscale, every processing stage works on intensities
+            image = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
             if image is None:
                 raise ValueError(f"Could not load image: {file_path}")
             
-            return self.process_omr_image(image, file_path)
+            return self.process_omr_image(image, file_path, return_encoded=return_encoded)
             
         except Exception as e:
-            print(f"Error processing OMR file: {e}")
+            logger.exception("Error processing OMR file")
             return {
                 "success": False,
                 "error": str(e),
@@ -247,50 +274,74 @@ class OMRCore:
                 "scoring_report": None
             }
     
-    def batch_process(self, input_dir: str, output_dir: str = None) -> List[Dict[str, Any]]:
-        """Process multiple OMR files in batch"""
+    def batch_process(self, input_dir: str, output_dir: str = None, max_workers: int = None) -> List[Dict[str, Any]]:
+        """Process multiple OMR files in batch, one worker process per CPU by default"""
         try:
             input_path = Path(input_dir)
             if not input_path.exists():
                 raise ValueError(f"Input directory does not exist: {input_dir}")
             
-            # Find OMR images
-            image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
-            omr_files = []
-            for ext in image_extensions:
-                omr_files.extend(input_path.glob(f"*{ext}"))
-                omr_files.extend(input_path.glob(f"*{ext.upper()}"))
+            # Find OMR images in a single directory pass
+            image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff'}
+            with os.scandir(input_path) as entries:
+                omr_files = sorted(
+                    Path(entry.path) for entry in entries
+                    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in image_extensions
+                )
             
             if not omr_files:
-                print(f"No OMR images found in {input_dir}")
+                logger.warning(f"No OMR images found in {input_dir}")
                 return []
             
-            print(f"Found {len(omr_files)} OMR images to process")
+            logger.info(f"Found {len(omr_files)} OMR images to process")
+            
+            if output_dir:
+                output_path = Path(output_dir)
+                output_path.mkdir(parents=True, exist_ok=True)
             
-            # Process each file
+            # Write visualizations on I/O threads while later files are still processing
             results = []
-            for file_path in omr_files:
-                print(f"Processing: {file_path.name}")
-                result = self.process_omr_file(str(file_path))
-                results.append({
-                    "file_path": str(file_path),
-                    "file_name": file_path.name,
-                    **result
-                })
+            with ThreadPoolExecutor(max_workers=2) as io_executor:
+                writes = []
+                for file_path, result in zip(omr_files, self._iter_file_results(omr_files, max_workers)):
+                    results.append({
+                        "file_path": str(file_path),
+                        "file_name": file_path.name,
+                        **result
+                    })
+                    
+                    # Save visualization if output directory specified
+                    if output_dir and result.get("success") and result.get("visualization_png"):
+                        vis_path = output_path / f"vis_{file_path.stem}.png"
+                        writes.append(io_executor.submit(vis_path.write_bytes, result["visualization_png"]))
                 
-                # Save visualization if output directory specified
-                if output_dir and result.get("success") and result.get("visualization") is not None:
-                    output_path = Path(output_dir)
-                    output_path.mkdir(parents=True, exist_ok=True)
-                    vis_path = output_path / f"vis_{file_path.name}"
-                    cv2.imwrite(str(vis_path), result["visualization"])
+                for write in writes:
+                    write.result()
             
             return results
             
-        except Exception as e:
-            print(f"Error in batch processing: {e}")
+        except Exception:
+            logger.exception("Error in batch processing")
             return []
     
+    def _iter_file_results(self, omr_files: List[Path], max_workers: int = None):
+        """Yield processing results in file order with PNG-encoded visualizations, from worker processes when there is more than one file"""
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        max_workers = min(max_workers, len(omr_files))
+        
+        if max_workers > 1 and self.template and self.evaluator:
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_batch_worker,
+                initargs=(self.config, self.template.path, self.evaluator.config)
+            ) as executor:
+                yield from executor.map(_process_omr_file_worker, [str(file_path) for file_path in omr_files])
+        else:
+            for file_path in omr_files:
+                logger.debug(f"Processing: {file_path.name}")
+                yield self.process_omr_file(str(file_path), return_encoded=True)
+    
     def get_template_info(self) -> Dict[str, Any]:
         """Get information about loaded template"""
         if not self.template:
@@ -314,7 +365,21 @@ class OMRCore:
     def save_results_csv(self, results: List[Dict[str, Any]], output_path: str):
         """Save batch processing results to CSV"""
         try:
-            import csv
+            # Flatten reports first so the writer serializes all rows in one call
+            rows = [
+                [
+                    result.get("file_name", ""),
+                    result.get("success", False),
+                    scoring_report.total_score,
+                    scoring_report.percentage,
+                    scoring_report.correct_answers,
+                    scoring_report.incorrect_answers,
+                    scoring_report.unmarked_answers,
+                    result.get("processing_time_ms", 0)
+                ]
+                for result in results
+                if (scoring_report := result.get("scoring_report"))
+            ]
             
             with open(output_path, 'w', newline='') as f:
                 writer = csv.writer(f)
@@ -327,24 +392,32 @@ class OMRCore:
                 ])
                 
                 # Write results
-                for result in results:
-                    scoring_report = result.get("scoring_report")
-                    if scoring_report:
-                        writer.writerow([
-                            result.get("file_name", ""),
-                            result.get("success", False),
-                            scoring_report.total_score,
-                            scoring_report.percentage,
-                            scoring_report.correct_answers,
-                            scoring_report.incorrect_answers,
-                            scoring_report.unmarked_answers,
-                            result.get("processing_time_ms", 0)
-                        ])
-            
-            print(f"Results saved to: {output_path}")
+                writer.writerows(rows)
             
-        except Exception as e:
-            print(f"Error saving results CSV: {e}")
+            logger.info(f"Results saved to: {output_path}")
+            
+        except Exception:
+            logger.exception("Error saving results CSV")
+
+
+# OMR core of a batch worker process, built once by _init_batch_worker
+_worker_core = None
+
+
+def _init_batch_worker(config: Dict[str, Any], template_path: str, evaluation_config: Dict[str, Any]):
+    """Build the OMR core a batch worker process reuses for all of its files"""
+    global _worker_core
+    # One OpenCV thread per worker, the pool already uses every core
+    cv2.setNumThreads(1)
+    _worker_core = OMRCore(config)
+    _worker_core.load_template(template_path)
+    _worker_core.evaluator = OMREvaluator(evaluation_config)
+
+
+def _process_omr_file_worker(file_path: str) -> Dict[str, Any]:
+    """Process one file in a batch worker process"""
+    logger.debug(f"Processing: {Path(file_path).name}")
+    return _worker_core.process_omr_file(file_path, return_encoded=True)
 
 
 def create_omr_core(config: Dict[str, Any] = None) -> OMRCore:
@@ -5,10 +5,15 @@ Handles answer key matching and flexible scoring schemes
 
 import csv
 import json
+import logging
+import sys
+import numpy as np
 from typing import Dict, List, Tuple, Optional, Any
 from dataclasses import dataclass
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class EvaluationResult:
@@ -33,6 +38,7 @@ class ScoringReport:
     multi_marked_answers: int
     evaluation_results: List[EvaluationResult]
     subject_scores: Dict[str, float] = None
+    evaluation_columns: Dict[str, list] = None  # question, student_answer, correct_answer, verdict, score
 
 
 class AnswerKeyManager:
@@ -44,6 +50,7 @@ class AnswerKeyManager:
         self.marking_schemes = {}
         self.load_answer_key()
         self.load_marking_schemes()
+        self.build_answer_arrays()
     
     def load_answer_key(self):
         """Load answer key from configured source"""
@@ -64,21 +71,30 @@ class AnswerKeyManager:
             csv_path = self.config.get("options", {}).get("answer_key_csv_path", "answer_key.csv")
             
             if not Path(csv_path).exists():
-                print(f"Answer key CSV not found: {csv_path}")
+                logger.warning(f"Answer key CSV not found: {csv_path}")
                 return
             
             with open(csv_path, 'r') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    question = row.get('question', '')
-                    answer = row.get('answer', '')
-                    if question and answer:
-                        self.answer_key[question] = answer
+                reader = csv.reader(f)
+                header = next(reader, [])
+                if 'question' not in header or 'answer' not in header:
+                    logger.warning(f"Answer key CSV needs 'question' and 'answer' columns: {csv_path}")
+                    return
+                
+                # Pick columns by position instead of building a dict per row
+                question_index = header.index('question')
+                answer_index = header.index('answer')
+                min_length = max(question_index, answer_index) + 1
+                self.answer_key.update(
+                    (sys.intern(row[question_index]), row[answer_index])
+                    for row in reader
+                    if len(row) >= min_length and row[question_index] and row[answer_index]
+                )
             
-            print(f"Loaded {len(self.answer_key)} answers from CSV")
+            logger.info(f"Loaded {len(self.answer_key)} answers from CSV")
             
-        except Exception as e:
-            print(f"Error loading answer key from CSV: {e}")
+        except Exception:
+            logger.exception("Error loading answer key from CSV")
     
     def load_from_json(self):
         """Load answer key from JSON file"""
@@ -86,26 +102,31 @@ class AnswerKeyManager:
             json_path = self.config.get("options", {}).get("answer_key_json_path", "answer_key.json")
             
             if not Path(json_path).exists():
-                print(f"Answer key JSON not found: {json_path}")
+                logger.warning(f"Answer key JSON not found: {json_path}")
                 return
             
             with open(json_path, 'r') as f:
                 data = json.load(f)
-                self.answer_key = data.get("answers", {})
+                self.answer_key = self.intern_questions(data.get("answers", {}))
             
-            print(f"Loaded {len(self.answer_key)} answers from JSON")
+            logger.info(f"Loaded {len(self.answer_key)} answers from JSON")
             
-        except Exception as e:
-            print(f"Error loading answer key from JSON: {e}")
+        except Exception:
+            logger.exception("Error loading answer key from JSON")
     
     def load_from_inline(self):
         """Load answer key from inline configuration"""
         try:
-            self.answer_key = self.config.get("options", {}).get("answers", {})
-            print(f"Loaded {len(self.answer_key)} answers from inline config")
+            self.answer_key = self.intern_questions(self.config.get("options", {}).get("answers", {}))
+            logger.info(f"Loaded {len(self.answer_key)} answers from inline config")
             
-        except Exception as e:
-            print(f"Error loading answer key from inline: {e}")
+        except Exception:
+            logger.exception("Error loading answer key from inline")
+    
+    @staticmethod
+    def intern_questions(answers: Dict[str, str]) -> Dict[str, str]:
+        """Intern question keys so lookups against template labels compare by identity"""
+        return {sys.intern(str(question)): answer for question, answer in answers.items()}
     
     def load_marking_schemes(self):
         """Load marking schemes"""
@@ -116,6 +137,25 @@ class AnswerKeyManager:
                 "unmarked": "0"
             }
         })
+        self.marking_scheme_floats = {
+            name: {verdict: float(score) for verdict, score in scheme.items()}
+            for name, scheme in self.marking_schemes.items()
+        }
+        self.max_possible_scores = {
+            name: len(self.answer_key) * scores["correct"]
+            for name, scores in self.marking_scheme_floats.items()
+        }
+    
+    def build_answer_arrays(self):
+        """Build question and correct answer arrays in answer key order"""
+        self.question_order = list(self.answer_key.keys())
+        self.correct_array = np.array([str(answer) for answer in self.answer_key.values()], dtype=str)
+    
+    def get_correct_array(self, questions: List[str]) -> np.ndarray:
+        """Get correct answers for the given questions as a string array"""
+        if questions == self.question_order:
+            return self.correct_array
+        return np.array([str(self.answer_key.get(question, "")) for question in questions], dtype=str)
     
     def get_answer(self, question: str) -> str:
         """Get correct answer for a question"""
@@ -124,6 +164,10 @@ class AnswerKeyManager:
     def get_marking_scheme(self, scheme_name: str = "DEFAULT") -> Dict[str, str]:
         """Get marking scheme by name"""
         return self.marking_schemes.get(scheme_name, self.marking_schemes["DEFAULT"])
+    
+    def get_marking_scheme_floats(self, scheme_name: str = "DEFAULT") -> Dict[str, float]:
+        """Get marking scheme scores by name, parsed to floats"""
+        return self.marking_scheme_floats.get(scheme_name, self.marking_scheme_floats["DEFAULT"])
 
 
 class OMREvaluator:
@@ -133,59 +177,104 @@ class OMREvaluator:
         self.config = evaluation_config
         self.answer_key_manager = AnswerKeyManager(evaluation_config)
         self.should_explain_scoring = evaluation_config.get("options", {}).get("should_explain_scoring", True)
+        # Scheme scores are fixed for the evaluator's lifetime, resolve them once
+        self.marking_scheme = self.answer_key_manager.get_marking_scheme_floats()
+        self.max_possible_score = self.answer_key_manager.max_possible_scores["DEFAULT"]
+        self.build_subject_map()
+    
+    def build_subject_map(self):
+        """Map each question to a subject index once, aligned with the answer key order"""
+        subjects = self.config.get("subjects", [])
+        self.subject_names = [subject["name"] for subject in subjects]
+        self.question_subjects = {
+            question: subject_id
+            for subject_id, subject in enumerate(subjects)
+            for question in subject.get("questions", [])
+        }
+        self.subject_ids = np.array(
+            [self.question_subjects.get(question, -1) for question in self.answer_key_manager.question_order],
+            dtype=np.intp
+        )
     
     def evaluate_omr_response(self, omr_response: Dict[str, str], file_path: str = None) -> ScoringReport:
         """Evaluate OMR response against answer key"""
         try:
             evaluation_results = []
-            marking_scheme = self.answer_key_manager.get_marking_scheme()
+            correct_score = self.marking_scheme["correct"]
+            incorrect_score = self.marking_scheme["incorrect"]
+            unmarked_score = self.marking_scheme["unmarked"]
             
-            total_score = 0.0
-            correct_answers = 0
-            incorrect_answers = 0
-            unmarked_answers = 0
-            multi_marked_answers = 0
+            # Walk the answer key when it covers the same questions, so its arrays are reused as-is
+            answer_key_manager = self.answer_key_manager
+            if omr_response.keys() == answer_key_manager.answer_key.keys():
+                questions = answer_key_manager.question_order
+                student_answers = [omr_response[question] for question in questions]
+            else:
+                questions = list(omr_response.keys())
+                student_answers = list(omr_response.values())
             
-            # Evaluate each question
-            for question, student_answer in omr_response.items():
-                correct_answer = self.answer_key_manager.get_answer(question)
-                
-                # Determine verdict and score
-                if student_answer == correct_answer:
-                    verdict = "correct"
-                    score = float(marking_scheme["correct"])
-                    correct_answers += 1
-                elif student_answer == "" or student_answer is None:
-                    verdict = "unmarked"
-                    score = float(marking_scheme["unmarked"])
-                    unmarked_answers += 1
-                elif len(student_answer) > 1:
-                    verdict = "multi_marked"
-                    score = 0.0  # Multi-marked questions typically get 0
-                    multi_marked_answers += 1
-                else:
-                    verdict = "incorrect"
-                    score = float(marking_scheme["incorrect"])
-                    incorrect_answers += 1
-                
-                total_score += score
-                
-                # Create evaluation result
-                evaluation_result = EvaluationResult(
-                    question=question,
-                    student_answer=student_answer,
-                    correct_answer=correct_answer,
-                    verdict=verdict,
-                    score=score
-                )
-                evaluation_results.append(evaluation_result)
+            # Compare all questions at once
+            student_array = np.array([answer or "" for answer in student_answers], dtype=str)
+            correct_array = answer_key_manager.get_correct_array(questions)
+            
+            correct_mask = student_array == correct_array
+            if None in student_answers:
+                correct_mask &= np.array([answer is not None for answer in student_answers])
+            unmarked_mask = ~correct_mask & (student_array == "")
+            multi_marked_mask = ~correct_mask & (np.char.str_len(student_array) > 1)
+            incorrect_mask = ~(correct_mask | unmarked_mask | multi_marked_mask)
+            
+            correct_answers = int(np.count_nonzero(correct_mask))
+            incorrect_answers = int(np.count_nonzero(incorrect_mask))
+            unmarked_answers = int(np.count_nonzero(unmarked_mask))
+            multi_marked_answers = int(np.count_nonzero(multi_marked_mask))
+            
+            # Multi-marked questions typically get 0
+            total_score = (correct_answers * correct_score
+                           + incorrect_answers * incorrect_score
+                           + unmarked_answers * unmarked_score)
+            
+            # Per-question scores stay in one array for the subject reduction
+            scores = np.select(
+                [correct_mask, unmarked_mask, incorrect_mask],
+                [correct_score, unmarked_score, incorrect_score],
+                default=0.0
+            )
+            
+            # Keep per-question detail as plain columns, EvaluationResult objects only when reported
+            evaluation_columns = {
+                "question": list(questions),
+                "student_answer": student_answers,
+                "correct_answer": correct_array.tolist(),
+                "verdict": np.select(
+                    [correct_mask, unmarked_mask, multi_marked_mask],
+                    ["correct", "unmarked", "multi_marked"],
+                    default="incorrect"
+                ).tolist(),
+                "score": scores.tolist()
+            }
+            if self.should_explain_scoring:
+                evaluation_results = [
+                    EvaluationResult(
+                        question=question,
+                        student_answer=student_answer,
+                        correct_answer=correct_answer,
+                        verdict=verdict,
+                        score=score
+                    )
+                    for question, student_answer, correct_answer, verdict, score
+                    in zip(*evaluation_columns.values())
+                ]
             
             # Calculate percentage
-            max_possible_score = len(omr_response) * float(marking_scheme["correct"])
+            if len(omr_response) == len(answer_key_manager.answer_key):
+                max_possible_score = self.max_possible_score
+            else:
+                max_possible_score = len(omr_response) * correct_score
             percentage = (total_score / max_possible_score * 100) if max_possible_score > 0 else 0
             
             # Calculate subject scores if subjects are defined
-            subject_scores = self.calculate_subject_scores(evaluation_results)
+            subject_scores = self.calculate_subject_scores(questions, scores)
             
             return ScoringReport(
                 total_score=total_score,
@@ -196,11 +285,12 @@ class OMREvaluator:
                 unmarked_answers=unmarked_answers,
                 multi_marked_answers=multi_marked_answers,
                 evaluation_results=evaluation_results,
-                subject_scores=subject_scores
+                subject_scores=subject_scores,
+                evaluation_columns=evaluation_columns
             )
             
-        except Exception as e:
-            print(f"Error in evaluate_omr_response: {e}")
+        except Exception:
+            logger.exception("Error in evaluate_omr_response")
             return ScoringReport(
                 total_score=0.0,
                 max_possible_score=0.0,
@@ -213,19 +303,31 @@ class OMREvaluator:
                 subject_scores={}
             )
     
-    def calculate_subject_scores(self, evaluation_results: List[EvaluationResult]) -> Dict[str, float]:
+    def calculate_subject_scores(self, questions: List[str], scores: np.ndarray) -> Dict[str, float]:
         """Calculate scores by subject if subjects are defined"""
         try:
-            # This is a simplified version - in practice, you'd need to map questions to subjects
-            # For now, we'll just return the total score
-            total_score = sum(result.score for result in evaluation_results)
-            
-            return {
-                "Total": total_score
+            subject_scores = {
+                "Total": float(scores.sum())
             }
             
-        except Exception as e:
-            print(f"Error in calculate_subject_scores: {e}")
+            if self.subject_names:
+                # Sum scores per subject in one pass over precomputed subject indices
+                if questions is self.answer_key_manager.question_order:
+                    subject_ids = self.subject_ids
+                else:
+                    subject_ids = np.array([self.question_subjects.get(question, -1) for question in questions], dtype=np.intp)
+                known = subject_ids >= 0
+                sums = np.bincount(
+                    subject_ids[known],
+                    weights=scores[known],
+                    minlength=len(self.subject_names)
+                )
+                subject_scores.update(zip(self.subject_names, sums.tolist()))
+            
+            return subject_scores
+            
+        except Exception:
+            logger.exception("Error in calculate_subject_scores")
             return {}
     
     def generate_detailed_report(self, scoring_report: ScoringReport, file_path: str = None) -> str:
@@ -257,7 +359,7 @@ class OMREvaluator:
             return "\n".join(report_lines)
             
         except Exception as e:
-            print(f"Error generating detailed report: {e}")
+            logger.exception("Error generating detailed report")
             return f"Error generating report: {e}"
     
     def save_evaluation_csv(self, scoring_report: ScoringReport, file_path: str, output_path: str):
@@ -270,19 +372,22 @@ class OMREvaluator:
                 writer.writerow(['question', 'student_answer', 'correct_answer', 'verdict', 'score'])
                 
                 # Write results
-                for result in scoring_report.evaluation_results:
-                    writer.writerow([
-                        result.question,
-                        result.student_answer,
-                        result.correct_answer,
-                        result.verdict,
-                        result.score
-                    ])
+                if scoring_report.evaluation_results or not scoring_report.evaluation_columns:
+                    for result in scoring_report.evaluation_results:
+                        writer.writerow([
+                            result.question,
+                            result.student_answer,
+                            result.correct_answer,
+                            result.verdict,
+                            result.score
+                        ])
+                else:
+                    writer.writerows(zip(*scoring_report.evaluation_columns.values()))
             
-            print(f"Evaluation results saved to: {output_path}")
+            logger.info(f"Evaluation results saved to: {output_path}")
             
-        except Exception as e:
-            print(f"Error saving evaluation CSV: {e}")
+        except Exception:
+            logger.exception("Error saving evaluation CSV")
 
 
 class EvaluationConfig:
@@ -316,13 +421,18 @@ class EvaluationConfig:
         """Create evaluation config from test data"""
         config = EvaluationConfig.create_default_config()
         
-        # Create answers dictionary from test data
+        # Create answers dictionary and subject question lists from test data
         answers = {}
+        subjects = []
         question_num = 1
         
-        for subject in test_subjects:
+        for index, subject in enumerate(test_subjects):
             subject_questions = subject.get("questions", 0)
             subject_answer_key = subject.get("answer_key", [])
+            subjects.append({
+                "name": subject.get("name", f"Subject_{index+1}"),
+                "questions": [f"q{question_num + i}" for i in range(subject_questions)]
+            })
             
             for i in range(subject_questions):
                 if i < len(subject_answer_key):
@@ -332,4 +442,5 @@ class EvaluationConfig:
                 question_num += 1
         
         config["options"]["answers"] = answers
+        config["subjects"] = subjects
         return config
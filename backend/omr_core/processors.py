@@ -4,12 +4,31 @@ Modular preprocessing components for robust image handling
 """
 
 import cv2
+import functools
+import logging
 import numpy as np
 from typing import Dict, List, Tuple, Optional, Any
 from abc import ABC, abstractmethod
 import json
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
+
+def _output_corners(width: int, height: int) -> np.ndarray:
+    """Corners of a width x height output image, clockwise from top-left"""
+    return np.array([
+        [0, 0],
+        [width - 1, 0],
+        [width - 1, height - 1],
+        [0, height - 1]
+    ], dtype=np.float32)
+
+
+def _corners_match(corners, dst_points: np.ndarray) -> bool:
+    """Whether every corner lies within half a pixel of its destination"""
+    return np.abs(np.asarray(corners, dtype=np.float32) - dst_points).max() <= 0.5
+
 
 class ImagePreprocessor(ABC):
     """Abstract base class for image preprocessors"""
@@ -26,19 +45,33 @@ class ImagePreprocessor(ABC):
 class CropPage(ImagePreprocessor):
     """Detect and crop page boundaries using edge detection"""
     
+    APPROX_EPSILONS = (0.01, 0.02, 0.04)
+    
     def __init__(self, options: Dict[str, Any] = None):
         super().__init__(options)
         self.morph_kernel = tuple(self.options.get("morphKernel", [10, 10]))
         self.min_page_area = self.options.get("minPageArea", 100000)
+        # Page corners are found on an image shrunk by this factor, then mapped back to full size
+        self.detection_downscale = max(1, int(self.options.get("detectionDownscale", 2)))
+        self.output_size = self.options.get("outputSize", (666, 820))
+        self.dst_points = _output_corners(*self.output_size)
     
     def apply_filter(self, image: np.ndarray, file_path: str) -> np.ndarray:
         """Detect page boundaries and crop image"""
         try:
-            # Convert to grayscale if needed
+            # Convert to grayscale if needed, normalize below writes a new array so no copy is needed
             if len(image.shape) == 3:
                 gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
             else:
-                gray = image.copy()
+                gray = image
+            
+            # Shrink for detection, the warp below still runs on the full image
+            downscale = self.detection_downscale
+            if downscale > 1:
+                gray = cv2.resize(
+                    gray, (gray.shape[1] // downscale, gray.shape[0] // downscale),
+                    interpolation=cv2.INTER_AREA
+                )
             
             # Normalize image
             gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX)
@@ -46,8 +79,11 @@ class CropPage(ImagePreprocessor):
             # Apply threshold
             _, thresh = cv2.threshold(gray, 200, 255, cv2.THRESH_TRUNC)
             
-            # Morphological operations
-            kernel = cv2.getStructuringElement(cv2.MORPH_RECT, self.morph_kernel)
+            # Morphological operations. OpenCV already runs rectangular kernels as separate
+            # row and column passes, and Canny stays because THRESH_TRUNC output is not binary
+            kernel = cv2.getStructuringElement(
+                cv2.MORPH_RECT, tuple(max(1, size // downscale) for size in self.morph_kernel)
+            )
             closed = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
             
             # Edge detection
@@ -55,25 +91,43 @@ class CropPage(ImagePreprocessor):
             
             # Find contours
             contours, _ = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-            contours = [cv2.convexHull(c) for c in contours]
             
-            # Find largest rectangular contour
-            for c in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
-                if cv2.contourArea(c) < self.min_page_area:
+            # A hull never covers more than its bounding box, so smaller boxes can never be the page
+            min_page_area = self.min_page_area / (downscale * downscale)
+            contours = [
+                cv2.convexHull(c) for c in contours
+                if (rect := cv2.boundingRect(c))[2] * rect[3] >= min_page_area
+            ]
+            
+            # Find largest rectangular contour among the five largest by area
+            areas = np.fromiter((cv2.contourArea(c) for c in contours), dtype=np.float64, count=len(contours))
+            if len(areas) > 5:
+                top = np.argpartition(-areas, 4)[:5]
+            else:
+                top = np.arange(len(areas))
+            for i in top[np.argsort(-areas[top], kind="stable")]:
+                c = contours[i]
+                if areas[i] < min_page_area:
                     continue
                 
+                # Loosen the approximation until it settles on four corners
                 peri = cv2.arcLength(c, True)
-                approx = cv2.approxPolyDP(c, epsilon=0.025 * peri, closed=True)
-                
-                if self._validate_rect(approx):
-                    # Apply perspective transformation
-                    return self._crop_and_align(image, approx)
+                for eps in self.APPROX_EPSILONS:
+                    approx = cv2.approxPolyDP(c, epsilon=eps * peri, closed=True)
+                    if len(approx) > 4:
+                        continue
+                    
+                    if self._validate_rect(approx):
+                        # Apply perspective transformation with corners mapped back to full size
+                        corners = approx.astype(np.float32) * downscale + (downscale - 1) / 2
+                        return self._crop_and_align(image, corners)
+                    break
             
             # If no page found, return original
             return image
             
-        except Exception as e:
-            print(f"Error in CropPage: {e}")
+        except Exception:
+            logger.exception("Error in CropPage")
             return image
     
     def _validate_rect(self, approx: np.ndarray) -> bool:
@@ -93,104 +147,135 @@ class CropPage(ImagePreprocessor):
         # Order points: top-left, top-right, bottom-right, bottom-left
         ordered_corners = self._order_points(corners.reshape(4, 2))
         
-        # Define destination points
-        width, height = self.options.get("outputSize", (666, 820))
-        dst_points = np.array([
-            [0, 0],
-            [width - 1, 0],
-            [width - 1, height - 1],
-            [0, height - 1]
-        ], dtype=np.float32)
+        # Skip the resample when the corners already sit on the output rectangle
+        width, height = self.output_size
+        if image.shape[:2] == (height, width) and _corners_match(ordered_corners, self.dst_points):
+            return image
         
         # Apply perspective transform
-        matrix = cv2.getPerspectiveTransform(ordered_corners.astype(np.float32), dst_points)
+        matrix = cv2.getPerspectiveTransform(ordered_corners.astype(np.float32), self.dst_points)
         aligned = cv2.warpPerspective(image, matrix, (width, height))
         
         return aligned
     
     def _order_points(self, points: np.ndarray) -> np.ndarray:
         """Order points in correct order for perspective transform"""
-        center = np.mean(points, axis=0)
-        angles = np.arctan2(points[:, 1] - center[1], points[:, 0] - center[0])
-        sorted_indices = np.argsort(angles)
-        return points[sorted_indices]
+        # Top-left has the smallest x + y and bottom-right the largest,
+        # top-right has the smallest y - x and bottom-left the largest
+        sums = points.sum(axis=1)
+        diffs = np.diff(points, axis=1).ravel()
+        return points[[sums.argmin(), diffs.argmin(), sums.argmax(), diffs.argmax()]]
 
 
 class CropOnMarkers(ImagePreprocessor):
     """Align image using reference markers"""
     
+    SCALES = [0.5, 0.75, 1.0, 1.25, 1.5]
+    
     def __init__(self, options: Dict[str, Any] = None):
         super().__init__(options)
         self.marker_path = self.options.get("markerPath", "")
         self.min_matching_threshold = self.options.get("minMatchingThreshold", 0.6)
         self.output_size = self.options.get("outputSize", (666, 820))
+        self.target_corners = _output_corners(*self.output_size)
+        
+        # The marker images are shared read-only; per-image state stays on this instance
+        self.marker, self.scaled_markers, self.coarse_markers = self._load_markers(self.marker_path)
+        self.best_scale = None
+        self.last_transform = None
+    
+    @classmethod
+    @functools.lru_cache(maxsize=8)
+    def _load_markers(cls, marker_path: str) -> Tuple[Optional[np.ndarray], Dict[float, np.ndarray], Dict[float, np.ndarray]]:
+        """Read a reference marker and its scaled variants once per path, they do not change between images"""
+        marker = None
+        scaled_markers = {}
+        coarse_markers = {}
+        if marker_path and Path(marker_path).exists():
+            marker = cv2.imread(marker_path, cv2.IMREAD_GRAYSCALE)
+        if marker is not None:
+            for scale in cls.SCALES:
+                h, w = int(marker.shape[0] * scale), int(marker.shape[1] * scale)
+                if h >= 10 and w >= 10:
+                    scaled_markers[scale] = cv2.resize(marker, (w, h))
+                    # Half-size copies for the scale search, which runs on a half-size image
+                    coarse_markers[scale] = cv2.resize(marker, (w // 2, h // 2), interpolation=cv2.INTER_AREA)
+        
+        return marker, scaled_markers, coarse_markers
     
     def apply_filter(self, image: np.ndarray, file_path: str) -> np.ndarray:
         """Align image using reference markers"""
         try:
-            if not self.marker_path or not Path(self.marker_path).exists():
+            if self.marker is None:
                 return image
             
-            # Load reference marker
-            marker = cv2.imread(self.marker_path, cv2.IMREAD_GRAYSCALE)
-            if marker is None:
-                return image
-            
-            # Convert image to grayscale
+            # Convert image to grayscale, matching only reads it so no copy is needed
             if len(image.shape) == 3:
                 gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
             else:
-                gray = image.copy()
+                gray = image
             
-            # Find best scale for marker
-            best_scale, optimal_marker = self._get_best_match(gray, marker)
-            if best_scale is None:
-                return image
-            
-            # Divide image into quadrants
-            h, w = gray.shape
-            midh, midw = h // 3, w // 2
-            quads = {
-                0: gray[0:midh, 0:midw],
-                1: gray[0:midh, midw:w],
-                2: gray[midh:h, 0:midw],
-                3: gray[midh:h, midw:w]
-            }
-            
-            # Match marker in each quadrant
-            centres = []
-            for k in range(4):
-                res = cv2.matchTemplate(quads[k], optimal_marker, cv2.TM_CCOEFF_NORMED)
-                max_t = res.max()
-                
-                if max_t < self.min_matching_threshold:
+            # Try the scale of the last aligned image before searching all scales again
+            centres = None
+            if self.best_scale is not None:
+                centres = self._find_centres(gray, self.scaled_markers[self.best_scale])
+            if centres is None:
+                best_scale, optimal_marker = self._get_best_match(gray)
+                if best_scale is None:
                     return image
-                
-                pt = np.argwhere(res == max_t)[0]
-                centres.append([pt[0] + optimal_marker.shape[0]//2, 
-                              pt[1] + optimal_marker.shape[1]//2])
+                centres = self._find_centres(gray, optimal_marker)
+                if centres is None:
+                    return image
+                self.best_scale = best_scale
             
             # Apply perspective transformation
             return self._apply_perspective_transform(image, centres)
             
-        except Exception as e:
-            print(f"Error in CropOnMarkers: {e}")
+        except Exception:
+            logger.exception("Error in CropOnMarkers")
             return image
     
-    def _get_best_match(self, image: np.ndarray, marker: np.ndarray) -> Tuple[Optional[float], Optional[np.ndarray]]:
+    def _find_centres(self, gray: np.ndarray, marker: np.ndarray) -> Optional[List[List[int]]]:
+        """Find the marker centre in each quadrant, or None if any match is too weak"""
+        # Divide image into quadrants
+        h, w = gray.shape
+        midh, midw = h // 3, w // 2
+        quads = {
+            0: gray[0:midh, 0:midw],
+            1: gray[0:midh, midw:w],
+            2: gray[midh:h, 0:midw],
+            3: gray[midh:h, midw:w]
+        }
+        
+        # Match marker in each quadrant
+        centres = []
+        for k in range(4):
+            res = cv2.matchTemplate(quads[k], marker, cv2.TM_CCOEFF_NORMED)
+            _, max_t, _, max_loc = cv2.minMaxLoc(res)
+            
+            if max_t < self.min_matching_threshold:
+                return None
+            
+            # minMaxLoc gives (x, y), centres are kept as (row, col)
+            centres.append([max_loc[1] + marker.shape[0]//2, 
+                          max_loc[0] + marker.shape[1]//2])
+        
+        return centres
+    
+    def _get_best_match(self, image: np.ndarray) -> Tuple[Optional[float], Optional[np.ndarray]]:
         """Find best scale for marker matching"""
-        scales = [0.5, 0.75, 1.0, 1.25, 1.5]
         best_scale = None
         best_max = 0
         
-        for scale in scales:
-            h, w = int(marker.shape[0] * scale), int(marker.shape[1] * scale)
-            if h < 10 or w < 10 or h > image.shape[0] or w > image.shape[1]:
+        # Compare scales at half resolution, each correlation then costs about a quarter
+        image = cv2.pyrDown(image)
+        for scale, scaled_marker in self.coarse_markers.items():
+            h, w = scaled_marker.shape
+            if h > image.shape[0] or w > image.shape[1]:
                 continue
             
-            scaled_marker = cv2.resize(marker, (w, h))
             res = cv2.matchTemplate(image, scaled_marker, cv2.TM_CCOEFF_NORMED)
-            max_val = res.max()
+            _, max_val, _, _ = cv2.minMaxLoc(res)
             
             if max_val > best_max:
                 best_max = max_val
@@ -199,24 +284,23 @@ class CropOnMarkers(ImagePreprocessor):
         if best_scale is None:
             return None, None
         
-        h, w = int(marker.shape[0] * best_scale), int(marker.shape[1] * best_scale)
-        optimal_marker = cv2.resize(marker, (w, h))
-        
-        return best_scale, optimal_marker
+        return best_scale, self.scaled_markers[best_scale]
     
     def _apply_perspective_transform(self, image: np.ndarray, centres: List[List[int]]) -> np.ndarray:
         """Apply perspective transformation using detected centres"""
-        # Define target corners
+        # Skip the resample when the centres already sit on the output rectangle
         width, height = self.output_size
-        target_corners = np.array([
-            [0, 0],
-            [width - 1, 0],
-            [width - 1, height - 1],
-            [0, height - 1]
-        ], dtype=np.float32)
+        if image.shape[:2] == (height, width) and _corners_match(centres, self.target_corners):
+            return image
         
-        # Apply perspective transform
-        matrix = cv2.getPerspectiveTransform(np.array(centres, dtype=np.float32), target_corners)
+        # Apply perspective transform, reusing the matrix while markers land on the same pixels.
+        # The (centres, matrix) pair is read and replaced as one tuple so callers never mix two images'
+        last_transform = self.last_transform
+        if last_transform is not None and last_transform[0] == centres:
+            matrix = last_transform[1]
+        else:
+            matrix = cv2.getPerspectiveTransform(np.array(centres, dtype=np.float32), self.target_corners)
+            self.last_transform = (centres, matrix)
         aligned = cv2.warpPerspective(image, matrix, (width, height))
         
         return aligned
@@ -230,23 +314,35 @@ class Levels(ImagePreprocessor):
         self.gamma = self.options.get("gamma", 1.0)
         self.alpha = self.options.get("alpha", 1.0)
         self.beta = self.options.get("beta", 0)
+        # Levels only map intensities, so both steps are precomputed as one table for uint8 images
+        self.lut = self._adjust(np.arange(256, dtype=np.uint8))
+    
+    def _adjust(self, image: np.ndarray) -> np.ndarray:
+        """Apply gamma correction, then brightness and contrast"""
+        # Apply gamma correction
+        if self.gamma != 1.0:
+            image = np.power(image / 255.0, self.gamma) * 255.0
+            image = np.clip(image, 0, 255).astype(np.uint8)
+        
+        # Apply brightness and contrast
+        if self.alpha != 1.0 or self.beta != 0:
+            image = cv2.convertScaleAbs(image, alpha=self.alpha, beta=self.beta)
+        
+        return image
     
     def apply_filter(self, image: np.ndarray, file_path: str) -> np.ndarray:
         """Apply gamma correction and brightness adjustment"""
         try:
-            # Apply gamma correction
-            if self.gamma != 1.0:
-                image = np.power(image / 255.0, self.gamma) * 255.0
-                image = np.clip(image, 0, 255).astype(np.uint8)
+            if image.dtype != np.uint8:
+                return self._adjust(image)
             
-            # Apply brightness and contrast
-            if self.alpha != 1.0 or self.beta != 0:
-                image = cv2.convertScaleAbs(image, alpha=self.alpha, beta=self.beta)
+            if self.gamma == 1.0 and self.alpha == 1.0 and self.beta == 0:
+                return image
             
-            return image
+            return cv2.LUT(image, self.lut)
             
-        except Exception as e:
-            print(f"Error in Levels: {e}")
+        except Exception:
+            logger.exception("Error in Levels")
             return image
 
 
@@ -262,8 +358,8 @@ class GaussianBlur(ImagePreprocessor):
         """Apply Gaussian blur"""
         try:
             return cv2.GaussianBlur(image, self.kernel_size, self.sigma)
-        except Exception as e:
-            print(f"Error in GaussianBlur: {e}")
+        except Exception:
+            logger.exception("Error in GaussianBlur")
             return image
 
 
@@ -317,16 +413,23 @@ class ImageInstanceOps:
             target_width = processing_dims.get("processing_width", 666)
             target_height = processing_dims.get("processing_height", 820)
             
-            image = cv2.resize(image, (target_width, target_height))
+            # Convert to grayscale once, every processor and bubble detection work on gray
+            if len(image.shape) == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
             
+            if image.shape[1] != target_width or image.shape[0] != target_height:
+                # Area averaging when shrinking, bilinear when enlarging
+                interpolation = cv2.INTER_AREA if image.shape[0] > target_height else cv2.INTER_LINEAR
+                image = cv2.resize(image, (target_width, target_height), interpolation=interpolation)
+
             # Apply each preprocessor
             for processor in preprocessors:
                 image = processor.apply_filter(image, file_path)
             
             return image
             
-        except Exception as e:
-            print(f"Error in apply_preprocessors: {e}")
+        except Exception:
+            logger.exception("Error in apply_preprocessors")
             return image
     
     def save_debug_image(self, image: np.ndarray, file_path: str, suffix: str = ""):
@@ -335,5 +438,5 @@ class ImageInstanceOps:
             try:
                 debug_path = Path(file_path).parent / f"debug_{suffix}_{Path(file_path).name}"
                 cv2.imwrite(str(debug_path), image)
-            except Exception as e:
-                print(f"Error saving debug image: {e}")
+            except Exception:
+                logger.exception("Error saving debug image")
@@ -4,12 +4,14 @@ Handles JSON-based template definitions for OMR layouts
 """
 
 import json
+import sys
+import numpy as np
 from typing import Dict, List, Tuple, Optional, Any
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 
 
-@dataclass
+@dataclass(slots=True)
 class Bubble:
     """Represents a single answer bubble"""
     x: float
@@ -33,10 +35,49 @@ class FieldBlock:
     shift: int = 0
     traverse_bubbles: List[List[Bubble]] = None
     
+    # Bubble geometry flattened in traversal order, built once per template load
+    bubble_xs: np.ndarray = field(default=None, init=False, repr=False, compare=False)
+    bubble_ys: np.ndarray = field(default=None, init=False, repr=False, compare=False)
+    bubble_values: List[str] = field(default=None, init=False, repr=False, compare=False)
+    question_labels: List[str] = field(default=None, init=False, repr=False, compare=False)
+    question_offsets: np.ndarray = field(default=None, init=False, repr=False, compare=False)
+    bubble_xy: np.ndarray = field(default=None, init=False, repr=False, compare=False)
+    _boxes_key: Tuple[int, int, int] = field(default=None, init=False, repr=False, compare=False)
+    _boxes: Tuple[np.ndarray, np.ndarray, np.ndarray] = field(default=None, init=False, repr=False, compare=False)
+    
     def __post_init__(self):
         if self.traverse_bubbles is None:
-            self.traverse_bubbles = []
             self.generate_bubble_grid()
+        self.build_bubble_arrays()
+    
+    def build_bubble_arrays(self):
+        """Cache bubble coordinates and values as flat arrays for vectorized detection"""
+        flat_bubbles = [bubble for field_bubbles in self.traverse_bubbles for bubble in field_bubbles]
+        
+        if self.bubble_xy is not None:
+            self.bubble_xs = self.bubble_xy[..., 0].ravel()
+            self.bubble_ys = self.bubble_xy[..., 1].ravel()
+        else:
+            self.bubble_xs = np.array([bubble.x for bubble in flat_bubbles], dtype=np.float64)
+            self.bubble_ys = np.array([bubble.y for bubble in flat_bubbles], dtype=np.float64)
+        self.bubble_values = [bubble.field_value for bubble in flat_bubbles]
+        self.question_labels = [field_bubbles[0].field_label for field_bubbles in self.traverse_bubbles if field_bubbles]
+        self.question_offsets = np.cumsum(
+            [0] + [len(field_bubbles) for field_bubbles in self.traverse_bubbles if field_bubbles]
+        )
+    
+    def get_bubble_boxes(self, height: int, width: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Integer bubble origins and in-bounds mask for an image size, cached per size and shift"""
+        key = (height, width, self.shift)
+        if self._boxes_key != key:
+            box_w, box_h = self.bubble_dimensions
+            xs = (self.bubble_xs + self.shift).astype(np.int64)
+            ys = self.bubble_ys.astype(np.int64)
+            in_bounds = (ys >= 0) & (ys + box_h <= height) & (xs >= 0) & (xs + box_w <= width)
+            self._boxes = (xs, ys, in_bounds)
+            self._boxes_key = key
+        
+        return self._boxes
     
     def generate_bubble_grid(self):
         """Generate bubble grid based on field type and configuration"""
@@ -62,29 +103,26 @@ class FieldBlock:
         bubble_values = config["bubble_values"]
         direction = config["direction"]
         
-        # Direction mapping: 0=horizontal, 1=vertical
-        _h, _v = (1, 0) if direction == "vertical" else (0, 1)
-        
-        lead_point = [float(self.origin[0]), float(self.origin[1])]
+        # Offsets along the bubble values and along the labels, broadcast to (labels, values)
+        value_offsets, label_offsets = np.meshgrid(
+            np.arange(len(bubble_values)) * self.bubbles_gap,
+            np.arange(len(self.field_labels)) * self.labels_gap
+        )
+        if direction == "vertical":
+            xs, ys = label_offsets, value_offsets
+        else:
+            xs, ys = value_offsets, label_offsets
+        self.bubble_xy = np.stack(
+            [float(self.origin[0]) + xs, float(self.origin[1]) + ys], axis=-1
+        ).astype(np.float64)
         
-        for field_label in self.field_labels:
-            bubble_point = lead_point.copy()
-            field_bubbles = []
-            
-            for bubble_value in bubble_values:
-                field_bubbles.append(
-                    Bubble(
-                        x=bubble_point[0],
-                        y=bubble_point[1],
-                        field_label=field_label,
-                        field_type=self.field_type,
-                        field_value=bubble_value
-                    )
-                )
-                bubble_point[_h] += self.bubbles_gap
-            
-            self.traverse_bubbles.append(field_bubbles)
-            lead_point[_v] += self.labels_gap
+        self.traverse_bubbles = [
+            [
+                Bubble(x=x, y=y, field_label=field_label, field_type=self.field_type, field_value=bubble_value)
+                for (x, y), bubble_value in zip(label_points, bubble_values)
+            ]
+            for field_label, label_points in zip(self.field_labels, self.bubble_xy.tolist())
+        ]
 
 
 class Template:
@@ -164,9 +202,11 @@ class Template:
                 bubble_dimensions=self.bubble_dimensions,
                 bubbles_gap=block_config["bubblesGap"],
                 labels_gap=block_config["labelsGap"],
-                field_labels=block_config["fieldLabels"],
+                field_labels=[sys.intern(label) for label in block_config["fieldLabels"]],
                 empty_value=self.empty_value
             )
+            # Bubble bounds are validated once against the page the image is resized to
+            field_block.get_bubble_boxes(self.page_dimensions[1], self.page_dimensions[0])
             self.field_blocks.append(field_block)
     
     def get_field_block_by_name(self, name: str) -> Optional[FieldBlock]:
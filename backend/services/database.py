@@ -4,14 +4,22 @@ Handles all database operations using SQLAlchemy
 """
 
 import asyncio
-from typing import List, Optional, Dict, Any
-from datetime import datetime
-from sqlalchemy import create_engine, Column, String, Integer, Float, DateTime, Text, Boolean, text
+import base64
+import os
+import time
+import uuid
+from typing import Iterator, List, Optional, Dict, Any
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, Column, String, Integer, Float, DateTime, Text, Boolean, Index, case, func, inspect, text, tuple_, update
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy import JSON
+from sqlalchemy.dialects.postgresql import JSONB
 import json
 import logging
+import orjson
 
 from models.schemas import OMRProcessResponse, DatabaseResult
 from config.settings import get_settings
@@ -21,20 +29,64 @@ logger = logging.getLogger(__name__)
 # Database setup
 Base = declarative_base()
 
+# Postgres stores JSONB parsed, JSON columns would be re-parsed from text on every read
+JSONDocument = JSON().with_variant(JSONB(), "postgresql")
+
 class OMRResult(Base):
     """Database model for OMR results"""
     __tablename__ = "omr_results"
     
     id = Column(String, primary_key=True, index=True)
-    student_id = Column(String, index=True, nullable=False)
-    exam_version = Column(String, nullable=False)
-    subject_scores = Column(JSON, nullable=False)
+    student_id = Column(String, nullable=False)
+    exam_version = Column(String, index=True, nullable=False)
+    subject_scores = Column(JSONDocument, nullable=False)
     total_score = Column(Integer, nullable=False)
-    invalid_questions = Column(JSON, default=list)
-    processing_metadata = Column(JSON, nullable=False)
+    invalid_questions = Column(JSONDocument, default=list)
+    processing_metadata = Column(JSONDocument, nullable=False)
+    # Copies of processing_metadata fields, kept as indexed columns for filtering
+    evaluation_mode = Column(String, index=True, nullable=True)
+    bubbles_detected = Column(Integer, index=True, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     overlay_image_path = Column(String, nullable=True)
+    
+    # Newest-first listings: keyset pagination of all results (whose leading created_at
+    # also serves the 24 hour statistics cutoff) and a student's history
+    __table_args__ = (
+        Index("ix_omr_results_created_at_id", created_at.desc(), id.desc()),
+        Index("ix_omr_results_student_id_created_at", student_id, created_at.desc()),
+    )
+
+# Keys of a result dictionary, each named after its column
+RESULT_FIELDS = (
+    "id", "student_id", "exam_version", "subject_scores", "total_score", "invalid_questions",
+    "processing_metadata", "created_at", "updated_at", "overlay_image_path"
+)
+
+def _json_serializer(value: Any) -> str:
+    """Serialize a JSON column value with orjson"""
+    return orjson.dumps(value).decode()
+
+def _new_result_id() -> str:
+    """Unique result ID in the UUIDv7 layout, so IDs sort by creation time"""
+    # 48-bit millisecond timestamp, then 80 random bits with the version and variant fields set
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), "big")
+    value = (value & ~(0xF << 76)) | (0x7 << 76)
+    value = (value & ~(0x3 << 62)) | (0x2 << 62)
+    return str(uuid.UUID(int=value))
+
+def _encode_cursor(result: OMRResult) -> str:
+    """Opaque pagination cursor pointing just past a result"""
+    position = json.dumps([result.created_at.isoformat(), result.id])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+def _decode_cursor(cursor: str) -> tuple:
+    """(created_at, id) position of a cursor made by _encode_cursor"""
+    try:
+        created_at, result_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), result_id
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
 
 class DatabaseService:
     """Database service for OMR evaluation"""
@@ -43,6 +95,12 @@ class DatabaseService:
         self.settings = get_settings()
         self.engine = None
         self.SessionLocal = None
+        # Statistics scan the whole table, so they are reused until a write or the TTL expires
+        self._statistics = None
+        self._statistics_expiry = 0.0
+        # Results waiting for the insert in progress, as (result, future) pairs
+        self._save_queue = []
+        self._saving = False
         self._initialize_database()
     
     def _initialize_database(self):
@@ -52,13 +110,22 @@ class DatabaseService:
             database_url = self.settings.database_url
             
             # Create engine
-            self.engine = create_engine(database_url, echo=self.settings.debug)
+            self.engine = create_engine(
+                database_url,
+                echo=self.settings.debug,
+                json_serializer=_json_serializer,
+                json_deserializer=orjson.loads,
+                **self._engine_options(database_url)
+            )
             
             # Create session factory
             self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
             
             # Create tables
             Base.metadata.create_all(bind=self.engine)
+            self._migrate_schema()
+            
+            self._warm_pool()
             
             logger.info("Database initialized successfully")
             
@@ -66,8 +133,77 @@ class DatabaseService:
             logger.error(f"Database initialization failed: {e}")
             raise
     
+    def _migrate_schema(self):
+        """Bring tables created by older versions up to date: column types, metadata columns and indexes (safe to re-run)"""
+        existing = {column["name"]: column["type"] for column in inspect(self.engine).get_columns(OMRResult.__tablename__)}
+        table = OMRResult.__table__
+        backfills = {
+            "evaluation_mode": OMRResult.processing_metadata["evaluation_mode"].as_string(),
+            "bubbles_detected": OMRResult.processing_metadata["bubbles_detected"].as_integer()
+        }
+        # Postgres skips a column another process added since the inspection (SQLite has no such clause)
+        if_not_exists = " IF NOT EXISTS" if self.engine.dialect.name == "postgresql" else ""
+        
+        with self.engine.begin() as connection:
+            # Postgres tables created before JSONDocument keep json columns until converted
+            if self.engine.dialect.name == "postgresql":
+                for column in table.columns:
+                    if column.name in existing and isinstance(column.type, JSON) and not isinstance(existing[column.name], JSONB):
+                        connection.execute(text(
+                            f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE JSONB USING {column.name}::jsonb"
+                        ))
+                        logger.info(f"Converted column {table.name}.{column.name} to JSONB")
+            
+            for name, value in backfills.items():
+                if name in existing:
+                    continue
+                
+                column_type = table.c[name].type.compile(dialect=self.engine.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN{if_not_exists} {name} {column_type}"))
+                connection.execute(update(table).values({name: value, "updated_at": table.c.updated_at}))
+                logger.info(f"Added column {table.name}.{name}")
+            
+            # create_all only indexes new tables, so indexes added to the model later are created here
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+    
+    def _engine_options(self, database_url: str) -> Dict[str, Any]:
+        """Connection pool options for the configured database"""
+        if database_url.startswith("sqlite"):
+            # Requests run on worker threads; an in-memory database only exists on one connection
+            options = {"connect_args": {"check_same_thread": False}}
+            if ":memory:" in database_url or database_url.rstrip("/") == "sqlite:":
+                options["poolclass"] = StaticPool
+            return options
+        
+        return {
+            "pool_size": self.settings.database_pool_size,
+            "max_overflow": self.settings.database_max_overflow,
+            "pool_timeout": self.settings.database_pool_timeout,
+            "pool_recycle": self.settings.database_pool_recycle,
+            "pool_pre_ping": True
+        }
+    
+    def _warm_pool(self):
+        """Open pool_size connections up front so the first requests do not pay for connecting"""
+        if not hasattr(self.engine.pool, "size"):
+            return
+        
+        connections = []
+        try:
+            for _ in range(self.engine.pool.size()):
+                connections.append(self.engine.connect())
+        finally:
+            for connection in connections:
+                connection.close()
+    
     async def health_check(self) -> str:
         """Check database connection health"""
+        # Session work blocks on database I/O, so each call runs in a worker thread
+        return await asyncio.to_thread(self._health_check_sync)
+    
+    def _health_check_sync(self) -> str:
+        """Blocking body of health_check"""
         try:
             with self.SessionLocal() as session:
                 # Simple query to test connection
@@ -77,59 +213,120 @@ class DatabaseService:
             logger.error(f"Database health check failed: {e}")
             return f"error: {e}"
     
+    def new_result_id(self) -> str:
+        """ID to assign to a result before it is saved"""
+        return _new_result_id()
+    
     async def save_omr_result(self, result: OMRProcessResponse) -> str:
-        """Save OMR processing result to database"""
+        """Save OMR processing result to database, batched with results queued while an insert runs"""
+        future = asyncio.get_running_loop().create_future()
+        self._save_queue.append((result, future))
+        
+        # The first caller drains the queue; results arriving meanwhile go into the next insert
+        if not self._saving:
+            self._saving = True
+            batch = []
+            try:
+                while self._save_queue:
+                    batch, self._save_queue = self._save_queue, []
+                    outcomes = await asyncio.to_thread(self._save_batch_sync, [queued for queued, _ in batch])
+                    for (_, queued_future), outcome in zip(batch, outcomes):
+                        if isinstance(outcome, Exception):
+                            queued_future.set_exception(outcome)
+                        else:
+                            queued_future.set_result(outcome)
+            finally:
+                self._saving = False
+                # Only reached with waiting results when the drain itself was cancelled
+                for _, queued_future in batch + self._save_queue:
+                    if not queued_future.done():
+                        queued_future.cancel()
+                self._save_queue = []
+        
+        return await future
+    
+    def _save_batch_sync(self, results: List[OMRProcessResponse]) -> List[Any]:
+        """Save queued results, returning each one's ID or exception (blocking)"""
+        if len(results) == 1:
+            try:
+                return [self._save_omr_result_sync(results[0])]
+            except Exception as e:
+                return [e]
+        
+        try:
+            return self._save_omr_results_bulk_sync(results)
+        except Exception as e:
+            # One bad row fails the whole insert, so fall back to saving them one by one
+            logger.warning(f"Batched insert of {len(results)} OMR results failed, saving them one by one: {e}")
+            outcomes = []
+            for result in results:
+                try:
+                    outcomes.append(self._save_omr_result_sync(result))
+                except Exception as e:
+                    outcomes.append(e)
+            return outcomes
+    
+    def _save_omr_result_sync(self, result: OMRProcessResponse) -> str:
+        """Blocking body of save_omr_result"""
         try:
             with self.SessionLocal() as session:
-                # Generate unique ID
-                result_id = f"omr_{int(datetime.utcnow().timestamp())}_{result.student_id}"
-                
-                # Convert subject scores to dict
-                subject_scores_dict = {
-                    "math": result.subject_scores.math,
-                    "ai_ml": result.subject_scores.ai_ml,
-                    "stats": result.subject_scores.stats,
-                    "python": result.subject_scores.python,
-                    "genai": result.subject_scores.genai,
-                    "total": result.subject_scores.total
-                }
-                
-                # Convert processing metadata to dict
-                metadata_dict = {
-                    "processing_time_ms": result.processing_metadata.processing_time_ms,
-                    "image_width": result.processing_metadata.image_width,
-                    "image_height": result.processing_metadata.image_height,
-                    "bubbles_detected": result.processing_metadata.bubbles_detected,
-                    "invalid_questions": result.processing_metadata.invalid_questions,
-                    "error_messages": result.processing_metadata.error_messages,
-                    "evaluation_mode": result.processing_metadata.evaluation_mode.value,
-                    "exam_version": result.processing_metadata.exam_version
-                }
-                
                 # Create database record
-                db_result = OMRResult(
-                    id=result_id,
-                    student_id=result.student_id,
-                    exam_version=result.exam_version,
-                    subject_scores=subject_scores_dict,
-                    total_score=result.subject_scores.total,
-                    invalid_questions=result.invalid_questions,
-                    processing_metadata=metadata_dict,
-                    overlay_image_path=result.overlay_image_url
-                )
+                db_result = OMRResult(**self._result_row(result))
                 
                 session.add(db_result)
                 session.commit()
+                self._statistics = None
                 
-                logger.info(f"Saved OMR result: {result_id}")
-                return result_id
+                logger.info(f"Saved OMR result: {db_result.id}")
+                return db_result.id
                 
         except Exception as e:
             logger.error(f"Failed to save OMR result: {e}")
             raise
     
+    def _save_omr_results_bulk_sync(self, results: List[OMRProcessResponse]) -> List[str]:
+        """Save several OMR processing results with one multi-row insert and commit"""
+        rows = [self._result_row(result) for result in results]
+        
+        with self.SessionLocal() as session:
+            # Core insert with a parameter list runs as a single executemany
+            session.execute(OMRResult.__table__.insert(), rows)
+            session.commit()
+            self._statistics = None
+        
+        logger.info(f"Saved {len(rows)} OMR results")
+        return [row["id"] for row in rows]
+    
+    def _result_row(self, result: OMRProcessResponse) -> Dict[str, Any]:
+        """Column values of the database record for a processing result"""
+        # Dynamic subject scores are not stored
+        subject_scores_dict = result.subject_scores.model_dump(exclude={"subject_scores"})
+        metadata_dict = result.processing_metadata.model_dump(mode="json")
+        
+        # One clock read for both timestamps, so a new record's created_at and updated_at agree
+        now = datetime.utcnow()
+        
+        return {
+            "id": result.result_id or _new_result_id(),
+            "student_id": result.student_id,
+            "exam_version": result.exam_version,
+            "subject_scores": subject_scores_dict,
+            "total_score": result.subject_scores.total,
+            "invalid_questions": result.invalid_questions,
+            "processing_metadata": metadata_dict,
+            "evaluation_mode": metadata_dict["evaluation_mode"],
+            "bubbles_detected": metadata_dict["bubbles_detected"],
+            "overlay_image_path": result.overlay_image_url,
+            "created_at": now,
+            "updated_at": now
+        }
+    
     async def get_student_results(self, student_id: str) -> List[Dict[str, Any]]:
         """Get all results for a specific student"""
+        return await asyncio.to_thread(self._get_student_results_sync, student_id)
+    
+    def _get_student_results_sync(self, student_id: str) -> List[Dict[str, Any]]:
+        """Blocking body of get_student_results"""
         try:
             with self.SessionLocal() as session:
                 results = session.query(OMRResult).filter(
@@ -142,15 +339,62 @@ class DatabaseService:
             logger.error(f"Failed to get student results: {e}")
             raise
     
-    async def get_all_results(self, limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
-        """Get all OMR results with pagination"""
+    def iter_student_results(self, student_id: str, chunk_size: int = 100) -> Iterator[List[Dict[str, Any]]]:
+        """Yield a student's results newest first in lists of chunk_size, without loading them all (blocking)"""
         try:
             with self.SessionLocal() as session:
-                results = session.query(OMRResult).order_by(
-                    OMRResult.created_at.desc()
-                ).offset(offset).limit(limit).all()
+                results = session.query(OMRResult).filter(
+                    OMRResult.student_id == student_id
+                ).order_by(OMRResult.created_at.desc()).yield_per(chunk_size)
                 
-                return [self._convert_to_dict(result) for result in results]
+                chunk = []
+                for result in results:
+                    chunk.append(self._convert_to_dict(result))
+                    if len(chunk) == chunk_size:
+                        yield chunk
+                        chunk = []
+                if chunk:
+                    yield chunk
+                
+        except Exception as e:
+            logger.error(f"Failed to stream student results: {e}")
+            raise
+    
+    async def get_all_results(self, limit: int = 100, cursor: Optional[str] = None,
+                              fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Get a page of OMR results, newest first, starting after the given cursor"""
+        return await asyncio.to_thread(self._get_all_results_sync, limit, cursor, fields)
+    
+    def _get_all_results_sync(self, limit: int = 100, cursor: Optional[str] = None,
+                              fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Blocking body of get_all_results"""
+        fields = list(fields or RESULT_FIELDS)
+        unknown = [field for field in fields if field not in RESULT_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown result fields: {', '.join(unknown)}")
+        # A malformed cursor is a client error, raised before the query so it is not logged as a failure
+        position = _decode_cursor(cursor) if cursor else None
+        
+        try:
+            with self.SessionLocal() as session:
+                # Select plain columns instead of hydrating ORM objects; the cursor needs created_at and id
+                columns = fields + [name for name in ("created_at", "id") if name not in fields]
+                query = session.query(*(getattr(OMRResult, name) for name in columns))
+                
+                # Seek past the previous page instead of scanning and skipping it
+                if position:
+                    query = query.filter(
+                        tuple_(OMRResult.created_at, OMRResult.id) < tuple_(*position)
+                    )
+                
+                rows = query.order_by(
+                    OMRResult.created_at.desc(), OMRResult.id.desc()
+                ).limit(limit).all()
+                
+                return {
+                    "results": [dict(zip(fields, row)) for row in rows],
+                    "next_cursor": _encode_cursor(rows[-1]) if rows and len(rows) == limit else None
+                }
                 
         except Exception as e:
             logger.error(f"Failed to get all results: {e}")
@@ -158,6 +402,10 @@ class DatabaseService:
     
     async def get_result_by_id(self, result_id: str) -> Optional[Dict[str, Any]]:
         """Get specific result by ID"""
+        return await asyncio.to_thread(self._get_result_by_id_sync, result_id)
+    
+    def _get_result_by_id_sync(self, result_id: str) -> Optional[Dict[str, Any]]:
+        """Blocking body of get_result_by_id"""
         try:
             with self.SessionLocal() as session:
                 result = session.query(OMRResult).filter(
@@ -170,8 +418,36 @@ class DatabaseService:
             logger.error(f"Failed to get result by ID: {e}")
             raise
     
+    async def update_overlay_path(self, result_id: str, overlay_image_path: str) -> bool:
+        """Set the overlay image path of a result"""
+        return await asyncio.to_thread(self._update_overlay_path_sync, result_id, overlay_image_path)
+    
+    def _update_overlay_path_sync(self, result_id: str, overlay_image_path: str) -> bool:
+        """Blocking body of update_overlay_path"""
+        try:
+            with self.SessionLocal() as session:
+                result = session.query(OMRResult).filter(
+                    OMRResult.id == result_id
+                ).first()
+                
+                if result:
+                    result.overlay_image_path = overlay_image_path
+                    session.commit()
+                    return True
+                else:
+                    logger.warning(f"Result not found: {result_id}")
+                    return False
+                    
+        except Exception as e:
+            logger.error(f"Failed to update overlay path: {e}")
+            raise
+    
     async def delete_result(self, result_id: str) -> bool:
         """Delete result by ID"""
+        return await asyncio.to_thread(self._delete_result_sync, result_id)
+    
+    def _delete_result_sync(self, result_id: str) -> bool:
+        """Blocking body of delete_result"""
         try:
             with self.SessionLocal() as session:
                 result = session.query(OMRResult).filter(
@@ -181,6 +457,7 @@ class DatabaseService:
                 if result:
                     session.delete(result)
                     session.commit()
+                    self._statistics = None
                     logger.info(f"Deleted result: {result_id}")
                     return True
                 else:
@@ -193,37 +470,42 @@ class DatabaseService:
     
     async def get_statistics(self) -> Dict[str, Any]:
         """Get processing statistics"""
+        return await asyncio.to_thread(self._get_statistics_sync)
+    
+    def _get_statistics_sync(self) -> Dict[str, Any]:
+        """Blocking body of get_statistics"""
+        if self._statistics is not None and time.monotonic() < self._statistics_expiry:
+            return self._statistics
+        
         try:
             with self.SessionLocal() as session:
-                # Total results
-                total_results = session.query(OMRResult).count()
-                
-                # Average score
-                avg_score = session.query(
-                    session.query(OMRResult.total_score).label('avg')
-                ).scalar()
-                
-                # Results by exam version
-                version_counts = {}
-                for version in ['A', 'B', 'C', 'D']:
-                    count = session.query(OMRResult).filter(
-                        OMRResult.exam_version == version
-                    ).count()
-                    version_counts[version] = count
-                
-                # Recent results (last 24 hours)
-                from datetime import timedelta
+                # One grouped query gives the count, score sum and recent count (last 24 hours) per version
                 recent_cutoff = datetime.utcnow() - timedelta(hours=24)
-                recent_results = session.query(OMRResult).filter(
-                    OMRResult.created_at >= recent_cutoff
-                ).count()
+                rows = session.query(
+                    OMRResult.exam_version,
+                    func.count(OMRResult.id),
+                    func.sum(OMRResult.total_score),
+                    func.count(case((OMRResult.created_at >= recent_cutoff, 1)))
+                ).group_by(OMRResult.exam_version).all()
                 
-                return {
+                # Totals across versions, and counts for the standard versions
+                total_results = sum(row[1] for row in rows)
+                score_sum = sum(row[2] or 0 for row in rows)
+                avg_score = score_sum / total_results if total_results else None
+                recent_results = sum(row[3] for row in rows)
+                version_counts = dict.fromkeys(['A', 'B', 'C', 'D'], 0)
+                for version, count, _, _ in rows:
+                    if version in version_counts:
+                        version_counts[version] = count
+                
+                self._statistics = {
                     "total_results": total_results,
                     "average_score": float(avg_score) if avg_score else 0,
                     "results_by_version": version_counts,
                     "recent_results_24h": recent_results
                 }
+                self._statistics_expiry = time.monotonic() + self.settings.statistics_cache_ttl
+                return self._statistics
                 
         except Exception as e:
             logger.error(f"Failed to get statistics: {e}")
@@ -239,7 +521,7 @@ class DatabaseService:
             "total_score": result.total_score,
             "invalid_questions": result.invalid_questions,
             "processing_metadata": result.processing_metadata,
-            "created_at": result.created_at.isoformat(),
-            "updated_at": result.updated_at.isoformat() if result.updated_at else None,
+            "created_at": result.created_at,
+            "updated_at": result.updated_at,
             "overlay_image_path": result.overlay_image_path
         }
@@ -3,15 +3,21 @@ Core OMR Processing Service
 Implements the complete OMR evaluation pipeline using the comprehensive OMR core system
 """
 
+import asyncio
 import cv2
+import multiprocessing
 import numpy as np
 import json
+import logging
+import threading
 import time
 import os
-from typing import List, Dict, Tuple, Optional, Any
-from PIL import Image
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Dict, Tuple, Optional, Any
 import pytesseract
-from io import BytesIO
+from pydantic import TypeAdapter
 
 from models.schemas import (
     OMRProcessResponse, SubjectScores, BubbleDetection, 
@@ -20,12 +26,35 @@ from models.schemas import (
 from config.settings import get_settings
 from omr_core import OMRCore, create_omr_core
 
+logger = logging.getLogger(__name__)
+
+# Validates a whole list of detections in one pydantic-core call
+_bubble_detections_adapter = TypeAdapter(List[BubbleDetection])
+
+# First run of digits in an uploaded filename, taken as the student ID
+_STUDENT_ID_RE = re.compile(r'(\d+)')
+
 class OMRProcessor:
     """Main OMR processing service using comprehensive OMR core system"""
     
+    # Number of tests whose template and evaluator are kept ready
+    CORE_CACHE_SIZE = 32
+    
+    # Overlays are saved as JPEG: faster to encode than PNG and a fraction of the size for scanned sheets
+    OVERLAY_JPEG_QUALITY = 85
+    
+    # Overlay link given for results whose overlay is rendered on first request
+    DEFERRED_OVERLAY_URL = "/results/{result_id}/overlay"
+    
     def __init__(self):
         self.settings = get_settings()
         self.omr_core = None
+        self._output_dir = self.settings.output_dir
+        self._output_dir_ready = False
+        self._core_lock = threading.Lock()
+        self._core_cache = OrderedDict()
+        self._default_template = None
+        self._executor = None
         self._initialize_omr_core()
         
     def _initialize_omr_core(self):
@@ -65,111 +94,135 @@ class OMRProcessor:
             }
             
             self.omr_core = create_omr_core(config)
-            print("OMR Core system initialized successfully")
+            logger.info("OMR Core system initialized successfully")
             
         except Exception as e:
-            print(f"Error initializing OMR core: {e}")
+            logger.error(f"Error initializing OMR core: {e}")
             self.omr_core = None
     
     async def process_sheet(
         self, 
-        file_content: bytes, 
+        file_content: Optional[bytes], 
         filename: str, 
         evaluation_mode: str = "moderate",
         student_id: Optional[str] = None,
         test_subjects: Optional[List[Dict]] = None,
-        test_answer_key: Optional[List[str]] = None
+        test_answer_key: Optional[List[str]] = None,
+        file_path: Optional[str] = None,
+        include_overlay: bool = True,
+        result_id: Optional[str] = None
     ) -> OMRProcessResponse:
-        print(f"Processing OMR sheet: {filename}, size: {len(file_content)} bytes, mode: {evaluation_mode}, student: {student_id}")
         """
         Main OMR processing pipeline using comprehensive OMR core system
         
         Args:
-            file_content: Raw file bytes
+            file_content: Raw file bytes (ignored when file_path is given)
             filename: Original filename
             evaluation_mode: Evaluation mode (easy/moderate/strict)
             student_id: Optional student ID
             test_subjects: Test subjects configuration
             test_answer_key: Answer key for evaluation
+            file_path: Path of the upload on disk, read directly by OpenCV
+            include_overlay: Render and save the overlay image
+            result_id: ID the result will be stored under, also used to name the overlay image
             
         Returns:
             OMRProcessResponse with processing results
         """
-        start_time = time.time()
+        # OpenCV/NumPy work runs off the event loop so it stays responsive
+        return await self._run_blocking(
+            _process_sheet_worker, self._process_sheet_sync, file_content, filename, evaluation_mode,
+            student_id, test_subjects, test_answer_key, file_path, include_overlay, result_id
+        )
+    
+    async def _run_blocking(self, worker: Callable, method: Callable, *args):
+        """Run a blocking body in a sheet worker process when configured, else in a thread"""
+        if self.settings.omr_worker_processes <= 0:
+            return await asyncio.to_thread(method, *args)
+        
+        # Spawned rather than forked: the API process already runs threads
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.settings.omr_worker_processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_sheet_worker
+            )
+        return await asyncio.get_running_loop().run_in_executor(self._executor, worker, *args)
+    
+    def _process_sheet_sync(
+        self, 
+        file_content: Optional[bytes], 
+        filename: str, 
+        evaluation_mode: str,
+        student_id: Optional[str],
+        test_subjects: Optional[List[Dict]],
+        test_answer_key: Optional[List[str]],
+        file_path: Optional[str],
+        include_overlay: bool,
+        result_id: Optional[str]
+    ) -> OMRProcessResponse:
+        """Blocking body of process_sheet"""
+        logger.info(f"Processing OMR sheet: {filename}, source: {file_path or f'{len(file_content)} bytes'}, mode: {evaluation_mode}, student: {student_id}")
+        start_ns = time.perf_counter_ns()
         
         try:
-            print(f"Starting process_sheet with test_subjects: {test_subjects}")
-            print(f"OMR Core available: {self.omr_core is not None}")
+            # Diagnostics use lazy arguments so large reprs are only built when debugging
+            logger.debug("Starting process_sheet with test_subjects: %s", test_subjects)
+            logger.debug("OMR Core available: %s", self.omr_core is not None)
             
             if not self.omr_core:
                 raise Exception("OMR core system not initialized")
             
-            # Convert bytes to image
-            image = Image.open(BytesIO(file_content))
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+            # Decode straight to grayscale from disk or from the uploaded bytes (detection only needs grayscale)
+            if file_path:
+                cv_image = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
+            else:
+                cv_image = cv2.imdecode(np.frombuffer(file_content, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+            if cv_image is None:
+                raise Exception(f"Could not decode image: {filename}")
             
-            # Setup template and evaluator from test data
-            if test_subjects and test_answer_key:
-                print(f"Setting up template and evaluator from test data: {len(test_subjects)} subjects, {len(test_answer_key)} questions")
+            # The core's template and evaluator are shared state, so sheets are processed one at a time
+            with self._core_lock:
+                self._setup_core(test_subjects, test_answer_key)
                 
-                # Create template from test data
-                template_created = self.omr_core.create_template_from_test_data(test_subjects, test_answer_key)
-                if not template_created:
-                    raise Exception("Failed to create template from test data")
+                # Process OMR image using comprehensive system
+                logger.debug("Processing OMR image with comprehensive system...")
+                logger.debug("Template loaded: %s", self.omr_core.template is not None)
+                logger.debug("Evaluator setup: %s", self.omr_core.evaluator is not None)
                 
-                # Setup evaluator
-                self.omr_core.setup_evaluator(test_subjects, test_answer_key)
-            else:
-                # Use default template if available
-                template_path = "templates/default_template.json"
-                if not self.omr_core.load_template(template_path):
-                    # Create a basic template
-                    self.omr_core.create_template_from_test_data(
-                        [{"name": "Default", "questions": 20, "answer_key": ["A"] * 20}],
-                        ["A"] * 20
-                    )
-                    self.omr_core.setup_evaluator()
-            
-            # Process OMR image using comprehensive system
-            print("Processing OMR image with comprehensive system...")
-            print(f"OMR Core initialized: {self.omr_core is not None}")
-            print(f"Template loaded: {self.omr_core.template is not None if self.omr_core else False}")
-            print(f"Evaluator setup: {self.omr_core.evaluator is not None if self.omr_core else False}")
-            
-            try:
-                results = self.omr_core.process_omr_image(cv_image, filename)
-                print(f"Comprehensive system results: {results}")
+                try:
+                    results = self.omr_core.process_omr_image(cv_image, filename, include_overlay)
+                    logger.debug("Comprehensive system results: %s", results)
                 
-                if not results["success"]:
-                    raise Exception(f"OMR processing failed: {results.get('error', 'Unknown error')}")
-            except Exception as e:
-                print(f"Comprehensive system failed: {e}")
-                # Fall back to old system
-                print("Falling back to old OMR system...")
-                raise Exception(f"Comprehensive OMR system failed: {e}")
+                    if not results["success"]:
+                        raise Exception(f"OMR processing failed: {results.get('error', 'Unknown error')}")
+                except Exception as e:
+                    logger.error(f"Comprehensive system failed: {e}")
+                    raise Exception(f"Comprehensive OMR system failed: {e}")
             
             # Extract results
             omr_response = results["omr_response"]
             scoring_report = results["scoring_report"]
             processing_time = int(results["processing_time_ms"])
             
-            print(f"OMR Response: {omr_response}")
-            print(f"Scoring Report: {scoring_report}")
-            print(f"Test Subjects: {test_subjects}")
+            logger.debug("OMR Response: %s", omr_response)
+            logger.debug("Scoring Report: %s", scoring_report)
+            logger.debug("Test Subjects: %s", test_subjects)
             
             # Convert to legacy format for compatibility
             bubble_detections = self._convert_to_bubble_detections(omr_response)
             subject_scores = self._convert_to_subject_scores(scoring_report, test_subjects)
             invalid_questions = self._extract_invalid_questions(results["detection_metadata"])
             
-            print(f"Converted Subject Scores: {subject_scores}")
+            logger.debug("Converted Subject Scores: %s", subject_scores)
             
-            # Generate overlay image
-            overlay_url = await self._generate_overlay_image(
-                cv_image, bubble_detections, filename, results.get("visualization")
-            )
+            # Generate overlay image, or link to GET /results/{id}/overlay which renders it on first request
+            if include_overlay:
+                overlay_url = self._generate_overlay_image(
+                    cv_image, bubble_detections, filename, results.get("visualization"), result_id
+                )
+            else:
+                overlay_url = self.DEFERRED_OVERLAY_URL.format(result_id=result_id) if result_id else None
             
             # Create response
             response = OMRProcessResponse(
@@ -189,14 +242,15 @@ class OMRProcessor:
                     evaluation_mode=EvaluationMode(evaluation_mode),
                     exam_version="A"
                 ),
-                overlay_image_url=overlay_url
+                overlay_image_url=overlay_url,
+                result_id=result_id
             )
             
-            print(f"OMR processing completed successfully: {scoring_report.total_score:.2f}/{scoring_report.max_possible_score:.2f} ({scoring_report.percentage:.2f}%)")
+            logger.info(f"OMR processing completed successfully: {scoring_report.total_score:.2f}/{scoring_report.max_possible_score:.2f} ({scoring_report.percentage:.2f}%)")
             return response
             
         except Exception as e:
-            print(f"Error in process_sheet: {e}")
+            logger.error(f"Error in process_sheet: {e}")
             # Return error response
             return OMRProcessResponse(
                 success=False,
@@ -206,7 +260,7 @@ class OMRProcessor:
                     math=0, ai_ml=0, stats=0, python=0, genai=0, total=0
                 ),
                 processing_metadata=ProcessingMetadata(
-                    processing_time_ms=int((time.time() - start_time) * 1000),
+                    processing_time_ms=(time.perf_counter_ns() - start_ns) // 1_000_000,
                     image_width=0,
                     image_height=0,
                     bubbles_detected=0,
@@ -214,54 +268,134 @@ class OMRProcessor:
                     error_messages=[str(e)],
                     evaluation_mode=EvaluationMode(evaluation_mode),
                     exam_version="unknown"
-                )
+                ),
+                result_id=result_id
             )
     
-    def _convert_to_bubble_detections(self, omr_response: Dict[str, str]) -> List[BubbleDetection]:
-        """Convert OMR response to legacy bubble detection format"""
-        detections = []
-        question_num = 1
-        
-        for question, answer in omr_response.items():
-            if answer and answer != "":
-                # Create bubble detection for the selected answer
-                detection = BubbleDetection(
-                    question_number=question_num,
-                    bubble_letter=answer,
-                    is_filled=True,
-                    fill_percentage=0.8,  # Default confidence
-                    confidence=0.8,
-                    coordinates={
-                        'x': 0, 'y': 0, 'width': 20, 'height': 20
-                    }
-                )
-                detections.append(detection)
+    def _setup_core(self, test_subjects: Optional[List[Dict]], test_answer_key: Optional[List[str]]):
+        """Load the template and evaluator for a sheet; call with _core_lock held"""
+        # Setup template and evaluator from test data
+        if test_subjects and test_answer_key:
+            # Reuse what was built for the same test, sheets of one class usually arrive together
+            cache_key = json.dumps([test_subjects, test_answer_key], sort_keys=True)
+            cached = self._core_cache.get(cache_key)
+            if cached is not None:
+                self._core_cache.move_to_end(cache_key)
+                self.omr_core.template, self.omr_core.preprocessors, self.omr_core.evaluator = cached
+                return
+            
+            logger.info(f"Setting up template and evaluator from test data: {len(test_subjects)} subjects, {len(test_answer_key)} questions")
             
-            question_num += 1
+            # Create template from test data
+            template_created = self.omr_core.create_template_from_test_data(test_subjects, test_answer_key)
+            if not template_created:
+                raise Exception("Failed to create template from test data")
+            
+            # Setup evaluator
+            self.omr_core.setup_evaluator(test_subjects, test_answer_key)
+            
+            self._core_cache[cache_key] = (self.omr_core.template, self.omr_core.preprocessors, self.omr_core.evaluator)
+            if len(self._core_cache) > self.CORE_CACHE_SIZE:
+                self._core_cache.popitem(last=False)
+        else:
+            # Use default template if available, re-reading the file only when it changes
+            template_path = "templates/default_template.json"
+            mtime = os.stat(template_path).st_mtime_ns if os.path.exists(template_path) else None
+            if self._default_template is not None and self._default_template[0] == mtime:
+                self.omr_core.template, self.omr_core.preprocessors = self._default_template[1:]
+            elif self.omr_core.load_template(template_path):
+                self._default_template = (
+                    os.stat(template_path).st_mtime_ns, self.omr_core.template, self.omr_core.preprocessors
+                )
+            else:
+                # Create a basic template
+                self.omr_core.create_template_from_test_data(
+                    [{"name": "Default", "questions": 20, "answer_key": ["A"] * 20}],
+                    ["A"] * 20
+                )
+                self.omr_core.setup_evaluator()
+    
+    async def render_overlay(
+        self,
+        file_path: str,
+        filename: str,
+        test_subjects: Optional[List[Dict]] = None,
+        test_answer_key: Optional[List[str]] = None,
+        result_id: Optional[str] = None
+    ) -> Optional[str]:
+        """Re-run detection on a stored upload and save its overlay image, returning the overlay URL"""
+        return await self._run_blocking(
+            _render_overlay_worker, self._render_overlay_sync,
+            file_path, filename, test_subjects, test_answer_key, result_id
+        )
+    
+    def _render_overlay_sync(
+        self,
+        file_path: str,
+        filename: str,
+        test_subjects: Optional[List[Dict]],
+        test_answer_key: Optional[List[str]],
+        result_id: Optional[str]
+    ) -> Optional[str]:
+        """Blocking body of render_overlay"""
+        cv_image = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
+        if cv_image is None:
+            raise Exception(f"Could not decode image: {filename}")
+        
+        with self._core_lock:
+            self._setup_core(test_subjects, test_answer_key)
+            results = self.omr_core.process_omr_image(cv_image, filename)
         
-        return detections
+        if not results["success"]:
+            raise Exception(f"OMR processing failed: {results.get('error', 'Unknown error')}")
+        
+        bubble_detections = self._convert_to_bubble_detections(results["omr_response"])
+        return self._generate_overlay_image(
+            cv_image, bubble_detections, filename, results.get("visualization"), result_id
+        )
+    
+    def _convert_to_bubble_detections(self, omr_response: Dict[str, str]) -> List[BubbleDetection]:
+        """Convert OMR response to legacy bubble detection format"""
+        # One bubble detection per selected answer, numbered by position in the response
+        return _bubble_detections_adapter.validate_python([
+            {
+                "question_number": question_num,
+                "bubble_letter": answer,
+                "is_filled": True,
+                "fill_percentage": 0.8,  # Default confidence
+                "confidence": 0.8,
+                "coordinates": {'x': 0, 'y': 0, 'width': 20, 'height': 20}
+            }
+            for question_num, answer in enumerate(omr_response.values(), 1)
+            if answer
+        ])
     
     def _convert_to_subject_scores(self, scoring_report, test_subjects: Optional[List[Dict]] = None) -> SubjectScores:
         """Convert scoring report to legacy subject scores format"""
         if test_subjects:
             # Use test-specific subjects
             subject_scores = {}
-            total_questions = len(scoring_report.evaluation_results)
+            # Verdict columns are filled even when the evaluator does not explain scoring
+            if scoring_report.evaluation_columns:
+                verdicts = scoring_report.evaluation_columns["verdict"]
+            else:
+                verdicts = [result.verdict for result in scoring_report.evaluation_results]
+            total_questions = len(verdicts)
+            
+            # Correct answers before each question, so a subject's score is one difference
+            correct_before = np.concatenate(([0], np.cumsum(
+                [verdict == "correct" for verdict in verdicts], dtype=np.int64
+            )))
             
-            current_question = 1
+            current_question = 0
             for i, subject in enumerate(test_subjects):
                 subject_name = subject.get("name", f"Subject_{i+1}")
                 subject_questions = subject.get("questions", 0)
                 
-                # Calculate score for this subject
-                subject_score = 0
-                for j in range(current_question, current_question + subject_questions):
-                    if j <= len(scoring_report.evaluation_results):
-                        result = scoring_report.evaluation_results[j-1]
-                        if result.verdict == "correct":
-                            subject_score += 1
-                
-                subject_scores[subject_name] = subject_score
+                # Calculate score for this subject (questions past the response score nothing)
+                start = min(max(current_question, 0), total_questions)
+                end = min(max(current_question + subject_questions, start), total_questions)
+                subject_scores[subject_name] = int(correct_before[end] - correct_before[start])
                 current_question += subject_questions
             
             # For backward compatibility, also include the legacy format
@@ -295,31 +429,29 @@ class OMRProcessor:
     
     def _extract_invalid_questions(self, detection_metadata: Dict[str, Any]) -> List[int]:
         """Extract invalid questions from detection metadata"""
-        invalid_questions = []
-        
-        # Add multi-marked questions
-        multi_marked = detection_metadata.get("multi_marked", [])
-        for question in multi_marked:
-            # Extract question number from field label (e.g., "q1" -> 1)
-            if question.startswith("q"):
-                try:
-                    q_num = int(question[1:])
-                    invalid_questions.append(q_num)
-                except ValueError:
-                    pass
-        
-        return invalid_questions
+        # Multi-marked questions, numbered from their field label (e.g., "q1" -> 1)
+        return [
+            int(question[1:]) for question in detection_metadata.get("multi_marked", [])
+            if question.startswith("q") and question[1:].isdecimal()
+        ]
     
-    async def _generate_overlay_image(self, original_image: np.ndarray, detections: List[BubbleDetection], 
-                                    filename: str, visualization: np.ndarray = None) -> str:
+    def _generate_overlay_image(self, original_image: np.ndarray, detections: List[BubbleDetection], 
+                                    filename: str, visualization: np.ndarray = None,
+                                    result_id: Optional[str] = None) -> str:
         """Generate overlay image with detected bubbles marked"""
         try:
             if visualization is not None:
                 # Use the visualization from the comprehensive system
                 overlay = visualization
+            elif not detections:
+                # Nothing to draw, and imwrite only reads the image, so save it as is
+                overlay = original_image
             else:
                 # Create basic overlay
-                overlay = original_image.copy()
+                if len(original_image.shape) == 2:
+                    overlay = cv2.cvtColor(original_image, cv2.COLOR_GRAY2BGR)
+                else:
+                    overlay = original_image.copy()
                 
                 # Draw detected bubbles
                 for detection in detections:
@@ -335,22 +467,46 @@ class OMRProcessor:
                         thickness
                     )
             
-            # Save overlay image
-            timestamp = int(time.time())
-            overlay_filename = f"overlay_{timestamp}_{filename}"
-            overlay_path = os.path.join(self.settings.output_dir, overlay_filename)
+            # Save overlay image, named by the (time-ordered, unique) result ID when there is one
+            overlay_filename = f"overlay_{result_id or int(time.time())}_{os.path.splitext(filename)[0]}.jpg"
+            overlay_path = os.path.join(self._output_dir, overlay_filename)
             
-            cv2.imwrite(overlay_path, overlay)
+            if not self._output_dir_ready:
+                os.makedirs(self._output_dir, exist_ok=True)
+                self._output_dir_ready = True
+            
+            cv2.imwrite(overlay_path, overlay, [cv2.IMWRITE_JPEG_QUALITY, self.OVERLAY_JPEG_QUALITY])
             
             return f"/outputs/{overlay_filename}"
             
         except Exception as e:
-            print(f"Error generating overlay image: {e}")
+            logger.error(f"Error generating overlay image: {e}")
             return None
     
     def _extract_student_id(self, filename: str) -> str:
         """Extract student ID from filename"""
         # Try to extract student ID from filename
-        import re
-        match = re.search(r'(\d+)', filename)
+        match = _STUDENT_ID_RE.search(filename)
         return match.group(1) if match else f"student_{int(time.time())}"
+
+
+# OMR processor of a sheet worker process, built once by _init_sheet_worker
+_worker_processor = None
+
+
+def _init_sheet_worker():
+    """Build the OMR processor of a sheet worker process (its template cache lives for the process)"""
+    global _worker_processor
+    # One OpenCV thread per worker, the pool spreads sheets over the cores
+    cv2.setNumThreads(1)
+    _worker_processor = OMRProcessor()
+
+
+def _process_sheet_worker(*args) -> OMRProcessResponse:
+    """Process one sheet in a worker process"""
+    return _worker_processor._process_sheet_sync(*args)
+
+
+def _render_overlay_worker(*args) -> Optional[str]:
+    """Render one overlay in a worker process"""
+    return _worker_processor._render_overlay_sync(*args)
@@ -4,63 +4,74 @@ Test script for OMR Evaluation API
 """
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import orjson
+import functools
+import io
 import time
 from pathlib import Path
 
 API_BASE_URL = "http://localhost:8000"
 
+# One keep-alive connection pool for every request in the suite
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
 def test_health():
     """Test health endpoints"""
     print("🔍 Testing health endpoints...")
     
     # Test basic health
-    response = requests.get(f"{API_BASE_URL}/")
-    print(f"GET /: {response.status_code} - {response.json()}")
+    response = SESSION.get(f"{API_BASE_URL}/")
+    print(f"GET /: {response.status_code} - {orjson.loads(response.content)}")
     
     # Test detailed health
-    response = requests.get(f"{API_BASE_URL}/health")
-    print(f"GET /health: {response.status_code} - {response.json()}")
+    response = SESSION.get(f"{API_BASE_URL}/health")
+    print(f"GET /health: {response.status_code} - {orjson.loads(response.content)}")
 
-def test_omr_processing():
-    """Test OMR processing with a sample image"""
-    print("\n📊 Testing OMR processing...")
-    
+@functools.lru_cache(maxsize=1)
+def _fixture_png() -> bytes:
+    """PNG bytes of the synthetic OMR sheet, drawn once per run"""
     # Create a simple test image (you would replace this with actual OMR sheet)
-    from PIL import Image, ImageDraw
-    import io
+    from PIL import Image
+    import numpy as np
+    import cv2
     
-    # Create a simple test image
-    img = Image.new('RGB', (800, 1000), color='white')
-    draw = ImageDraw.Draw(img)
+    # One empty and one filled bubble, stamped into the page in a single assignment
+    bubble = np.full((21, 21), 255, dtype=np.uint8)
+    cv2.circle(bubble, (10, 10), 9, 0, 2)
+    filled = bubble.copy()
+    cv2.circle(filled, (10, 10), 8, 0, -1)
     
-    # Draw some test bubbles
-    for row in range(20):
-        for col in range(5):
-            x = 100 + col * 120
-            y = 100 + row * 40
-            
-            # Draw circle (bubble)
-            draw.ellipse([x, y, x+20, y+20], outline='black', width=2)
-            
-            # Fill some bubbles randomly
-            if (row + col) % 3 == 0:
-                draw.ellipse([x+2, y+2, x+18, y+18], fill='black')
+    # 20 rows x 5 columns of bubbles, filling some of them
+    rows, cols = np.meshgrid(np.arange(20), np.arange(5), indexing="ij")
+    ys = (100 + rows * 40).ravel()
+    xs = (100 + cols * 120).ravel()
+    stamps = np.where(((rows + cols) % 3 == 0).ravel()[:, None, None], filled, bubble)
     
-    # Save to bytes
+    canvas = np.full((1000, 800), 255, dtype=np.uint8)
+    offsets = np.arange(bubble.shape[0])
+    canvas[(ys[:, None] + offsets)[:, :, None], (xs[:, None] + offsets)[:, None, :]] = stamps
+    img = Image.fromarray(canvas)
+    
+    # Save to bytes (light compression: the image only travels to the local server)
     img_bytes = io.BytesIO()
-    img.save(img_bytes, format='PNG')
-    img_bytes.seek(0)
+    img.save(img_bytes, format='PNG', compress_level=1)
+    return img_bytes.getvalue()
+
+def test_omr_processing():
+    """Test OMR processing with a sample image"""
+    print("\n📊 Testing OMR processing...")
     
     # Test processing
-    files = {'file': ('test_omr.png', img_bytes, 'image/png')}
+    files = {'file': ('test_omr.png', io.BytesIO(_fixture_png()), 'image/png')}
     data = {
         'evaluation_mode': 'moderate',
         'student_id': 'test_student_001'
     }
     
     try:
-        response = requests.post(
+        response = SESSION.post(
             f"{API_BASE_URL}/process-omr",
             files=files,
             data=data,
@@ -70,7 +81,7 @@ def test_omr_processing():
         print(f"POST /process-omr: {response.status_code}")
         
         if response.status_code == 200:
-            result = response.json()
+            result = orjson.loads(response.content)
             print(f"✅ Processing successful!")
             print(f"   Student ID: {result['student_id']}")
             print(f"   Exam Version: {result['exam_version']}")
@@ -90,32 +101,44 @@ def test_results_endpoints():
     
     try:
         # Get all results
-        response = requests.get(f"{API_BASE_URL}/results?limit=10")
+        response = SESSION.get(f"{API_BASE_URL}/results?limit=10")
         print(f"GET /results: {response.status_code}")
         
         if response.status_code == 200:
-            results = response.json()
+            results = orjson.loads(response.content)
             print(f"   Found {len(results['results'])} results")
         
         # Get specific student results
-        response = requests.get(f"{API_BASE_URL}/results/test_student_001")
+        response = SESSION.get(f"{API_BASE_URL}/results/test_student_001")
         print(f"GET /results/test_student_001: {response.status_code}")
         
         if response.status_code == 200:
-            student_results = response.json()
+            student_results = orjson.loads(response.content)
             print(f"   Student has {len(student_results['results'])} results")
             
     except requests.exceptions.RequestException as e:
         print(f"❌ Request failed: {e}")
 
+def wait_for_server(attempts: int = 40, delay: float = 0.05) -> bool:
+    """Poll /health until the server reports healthy, returning whether it did"""
+    for _ in range(attempts):
+        try:
+            if SESSION.get(f"{API_BASE_URL}/health", timeout=0.25).ok:
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(delay)
+    return False
+
 def main():
     """Run all tests"""
     print("🚀 OMR Evaluation API Test Suite")
     print("=" * 50)
     
-    # Wait a moment for server to be ready
+    # Wait for the server to answer instead of sleeping a fixed time
     print("⏳ Waiting for server to be ready...")
-    time.sleep(2)
+    if not wait_for_server():
+        print("⚠️ Server did not report healthy, running tests anyway")
     
     try:
         test_health()
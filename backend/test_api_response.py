@@ -4,7 +4,6 @@ Test script to check API response structure
 """
 
 import asyncio
-import json
 from services.omr_processor import OMRProcessor
 from models.schemas import SubjectScores
 
@@ -27,11 +26,11 @@ async def test_api_response():
     print(f"Subject scores dict: {subject_scores.subject_scores}")
     
     # Convert to dict
-    scores_dict = subject_scores.dict()
+    scores_dict = subject_scores.model_dump()
     print(f"Dict representation: {scores_dict}")
     
-    # Convert to JSON
-    json_str = json.dumps(scores_dict)
+    # Convert to JSON in one pass, as /process-omr serializes its response
+    json_str = subject_scores.model_dump_json()
     print(f"JSON representation: {json_str}")
 
 if __name__ == "__main__":
@@ -6,7 +6,6 @@ This file redirects to the backend directory
 
 import os
 import sys
-import subprocess
 
 # Change to backend directory
 backend_dir = os.path.join(os.path.dirname(__file__), 'backend')
@@ -18,7 +17,11 @@ sys.path.insert(0, backend_dir)
 # Import and run the FastAPI app
 if __name__ == "__main__":
     import uvicorn
-    from main import app
     
+    # Pass the app as an import string so uvicorn can start WEB_CONCURRENCY worker processes;
+    # loop/http stay on "auto", which picks uvloop and httptools from uvicorn[standard].
+    # One worker by default: every worker runs the schema setup at startup and keeps its own
+    # statistics cache, so more than one needs a migrated database and tolerates stale statistics
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers)